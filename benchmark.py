@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import json
+import shutil
+import sqlite3
+import tempfile
+import platform
+import argparse
+import resource
+import subprocess
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+import nrrd
+
+
+#  Benchmark of the main stages of the tools on synthetic data
+#
+#  A synthetic study is generated offline (DICOM files with pydicom, and NRRD
+#  images with a label map and an image list file with pynrrd), and the
+#  following stages are timed:
+#    - index  : buildFilePathDBByTags() (dicom_to_nrrd.py)
+#    - export : groupBySeriesAndExport() (dicom_to_nrrd.py)
+#    - split  : extractDICOMByTag() (dicom_separate_by_tag.py)
+#    - sample : sampleIntensity() (sample_intensities.py)
+#  Each stage is run in a new process, so that its peak resident set size
+#  (including the worker processes it starts) can be measured. The results
+#  (files/s, MB/s, voxels/s and peak RSS) are written in the JSON format, to
+#  be compared across versions.
+#
+#  Example:
+#    benchmark.py --series 4 --slices 50 --matrix 256x256 -o result.json
+
+
+STAGES = ['index', 'export', 'split', 'sample']
+
+# Tags used to group the files in the export and split stages
+SERIES_TAGS = ['00200011', '00180082']
+
+
+#
+# Generate a synthetic DICOM study in 'dst': 'nSeries' series numbers x
+# 'nParams' inversion times, each with 'nSlices' slices of 'rows' x 'columns'.
+# Returns the number of files and their total size in bytes.
+#
+def generateDICOM(dst, nSeries=2, nSlices=20, rows=128, columns=128, nParams=2, seed=0):
+
+    os.makedirs(dst, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    studyUID = generate_uid()
+    nFiles = 0
+    nBytes = 0
+    for s in range(nSeries):
+        for p in range(nParams):
+            seriesUID = generate_uid()
+            for z in range(nSlices):
+                meta = FileMetaDataset()
+                meta.MediaStorageSOPClassUID = MRImageStorage
+                meta.MediaStorageSOPInstanceUID = generate_uid()
+                meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+                ds.SOPClassUID = MRImageStorage
+                ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+                ds.StudyInstanceUID = studyUID
+                ds.SeriesInstanceUID = seriesUID
+                ds.PatientName = 'Benchmark^Synthetic'
+                ds.StudyID = '1'
+                ds.SeriesNumber = s + 1
+                ds.SeriesDescription = 'Synthetic %d' % (s + 1)
+                ds.AcquisitionTime = '120000'
+                ds.InversionTime = 100 * (p + 1)
+                ds.InstanceNumber = z + 1
+                ds.ImagePositionPatient = [0.0, 0.0, 2.0 * z]
+                ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+                ds.PixelSpacing = [0.5, 0.5]
+                ds.SliceThickness = 2.0
+                ds.SliceLocation = 2.0 * z
+                ds.Rows = rows
+                ds.Columns = columns
+                ds.BitsAllocated = 16
+                ds.BitsStored = 12
+                ds.HighBit = 11
+                ds.PixelRepresentation = 0
+                ds.SamplesPerPixel = 1
+                ds.PhotometricInterpretation = 'MONOCHROME2'
+                ds.RescaleIntercept = 0
+                ds.RescaleSlope = 1
+                ds.PixelData = rng.integers(0, 4096, (rows, columns), dtype=np.uint16).tobytes()
+                path = os.path.join(dst, 'S%03d' % (s + 1), 'IM%06d' % nFiles)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                ds.save_as(path, enforce_file_format=True)
+                nFiles = nFiles + 1
+                nBytes = nBytes + os.path.getsize(path)
+
+    return (nFiles, nBytes)
+
+
+#
+# Generate 'nParams' synthetic NRRD images of 'shape' (x, y, z), a label map with
+# 'nROIs' box-shaped ROIs and an image list file ('list.json') in 'dst'.
+# Returns the number of voxels in the ROIs.
+#
+def generateNrrd(dst, nParams=4, shape=(128, 128, 20), nROIs=4, seed=0):
+
+    os.makedirs(dst, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    header = {
+        'space'            : 'left-posterior-superior',
+        'space directions' : np.diag([0.5, 0.5, 2.0]),
+        'space origin'     : np.zeros(3),
+        'kinds'            : ['domain', 'domain', 'domain'],
+        'encoding'         : 'raw',
+        }
+
+    label = np.zeros(shape, dtype=np.int16)
+    box = [max(1, n // 4) for n in shape]
+    for i in range(nROIs):
+        corner = [rng.integers(0, n - b + 1) for n, b in zip(shape, box)]
+        label[tuple(slice(c, c + b) for c, b in zip(corner, box))] = i + 1
+    nrrd.write(os.path.join(dst, 'label.nrrd'), label, header)
+
+    imageList = {'label' : 'label.nrrd'}
+    amplitude = 1000.0 + 500.0 * rng.random(shape)
+    t1 = 600.0 + 300.0 * (label % 3)
+    for p in range(nParams):
+        ti = 100.0 * (p + 1)
+        image = amplitude * (1.0 - 2.0 * np.exp(-ti / t1)) + rng.normal(0.0, 5.0, shape)
+        filename = 'image_%d.nrrd' % ti
+        nrrd.write(os.path.join(dst, filename), image.astype(np.int16), header)
+        imageList['%d' % ti] = filename
+    with open(os.path.join(dst, 'list.json'), 'w') as f:
+        json.dump(imageList, f, indent=4)
+
+    return int(np.count_nonzero(label)) * nParams
+
+
+#
+# Total number and size of the files in a directory
+#
+def directorySize(path):
+
+    nFiles = 0
+    nBytes = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            nFiles = nFiles + 1
+            nBytes = nBytes + os.path.getsize(os.path.join(root, file))
+    return (nFiles, nBytes)
+
+
+#
+# Peak resident set size (MB) of this process and of its terminated children
+#
+def peakRSS():
+
+    self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1.0 / 1024.0                # kB on Linux
+    if sys.platform == 'darwin':
+        scale = 1.0 / 1024.0 / 1024.0   # bytes on macOS
+    return (self * scale, children * scale)
+
+
+#
+# Run a stage (Called in a new process.) Returns a dictionary with the elapsed
+# time, the amount of data processed and the peak RSS.
+#
+def runStage(stage, workDir, params):
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import dicom_to_nrrd
+    import dicom_separate_by_tag
+    import sample_intensities
+    from dicom_header import HeaderScanStats, DICOMFileFilter
+    from file_transfer import FileTransfer
+
+    dicomDir = os.path.join(workDir, 'dicom')
+    outputDir = os.path.join(workDir, 'output-' + stage)
+    shutil.rmtree(outputDir, ignore_errors=True)
+    os.makedirs(outputDir)
+    nFiles, nBytes = directorySize(dicomDir)
+    voxels = nFiles * params['rows'] * params['columns']
+
+    # The progress messages of the tools (and of their worker processes) are
+    # discarded. (This process only runs this stage.)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+    start = time.time()
+    if stage == 'index':
+        con = sqlite3.connect(':memory:')
+        dicom_to_nrrd.buildFilePathDBByTags(con, dicomDir, SERIES_TAGS, True, params['jobs'], DICOMFileFilter())
+        con.close()
+    elif stage == 'export':
+        con = sqlite3.connect(':memory:')
+        dicom_to_nrrd.buildFilePathDBByTags(con, dicomDir, SERIES_TAGS, True, params['jobs'], DICOMFileFilter())
+        start = time.time()         # only the export is timed
+        options = {'encoding' : params['encoding']}
+        dicom_to_nrrd.groupBySeriesAndExport(con.cursor(), SERIES_TAGS, outputDir, params['jobs'], 2.5e8, options)
+        con.close()
+        nFiles, nBytes = directorySize(outputDir)
+    elif stage == 'split':
+        transfer = FileTransfer('copy')
+        dicom_separate_by_tag.extractDICOMByTag(dicomDir, outputDir, list(SERIES_TAGS), True, transfer, None, False,
+                                                HeaderScanStats(), DICOMFileFilter())
+        transfer.close()
+    elif stage == 'sample':
+        nrrdDir = os.path.join(workDir, 'nrrd')
+        sample_intensities.sampleIntensity(os.path.join(nrrdDir, 'list.json'), nrrdDir,
+                                           os.path.join(outputDir, 'intensities.csv'))
+        nFiles, nBytes = directorySize(nrrdDir)
+        voxels = params['sampledVoxels']
+    elapsed = time.time() - start
+
+    rss, childRSS = peakRSS()
+    return {
+        'seconds'      : elapsed,
+        'files'        : nFiles,
+        'bytes'        : nBytes,
+        'voxels'       : voxels,
+        'peakRSSMB'    : max(rss, childRSS),
+        }
+
+
+#
+# Run a stage 'repeat' times, each in a new process. The rates are computed
+# from the fastest run.
+#
+def benchmarkStage(stage, workDir, params, repeat=1):
+
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for i in range(repeat):
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            runs.append(executor.submit(runStage, stage, workDir, params).result())
+
+    best = min(runs, key=lambda r: r['seconds'])
+    seconds = max(best['seconds'], 1.0e-9)
+    return {
+        'seconds'         : best['seconds'],
+        'runs'            : [r['seconds'] for r in runs],
+        'files'           : best['files'],
+        'bytes'           : best['bytes'],
+        'voxels'          : best['voxels'],
+        'filesPerSecond'  : best['files'] / seconds,
+        'MBPerSecond'     : best['bytes'] / seconds / 1.0e6,
+        'voxelsPerSecond' : best['voxels'] / seconds,
+        'peakRSSMB'       : max([r['peakRSSMB'] for r in runs]),
+        }
+
+
+#
+# Version of the source tree (git), if available
+#
+def sourceVersion():
+
+    try:
+        output = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    if output.returncode != 0:
+        return None
+    return output.stdout.strip()
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Benchmark the DICOM/NRRD tools on synthetic data.')
+    parser.add_argument('--series', dest='series', type=int, default=2,
+                        help='number of series (default: 2)')
+    parser.add_argument('--params', dest='params', type=int, default=2,
+                        help='number of inversion times per series, and of images to be sampled (default: 2)')
+    parser.add_argument('--slices', dest='slices', type=int, default=20,
+                        help='number of slices (files) per series and inversion time (default: 20)')
+    parser.add_argument('--matrix', dest='matrix', type=str, default='128x128',
+                        help='matrix size of the slices, ROWSxCOLUMNS (default: 128x128)')
+    parser.add_argument('--rois', dest='rois', type=int, default=4,
+                        help='number of ROIs in the label map to be sampled (default: 4)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='number of processes for the index and export stages (default: 1)')
+    parser.add_argument('-e', '--encoding', dest='encoding', type=str, default='raw',
+                        choices=['raw', 'gzip', 'bzip2'],
+                        help='encoding of the exported NRRD files (default: raw)')
+    parser.add_argument('--stages', dest='stages', type=str, default=','.join(STAGES),
+                        help='comma-separated list of the stages to be run (default: %s)' % ','.join(STAGES))
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+                        help='number of runs of each stage; the fastest run is reported (default: 1)')
+    parser.add_argument('--work-dir', dest='workDir', type=str, default=None,
+                        help='directory for the synthetic data and the outputs (default: a temporary directory, '
+                        'removed at exit); existing synthetic data in the directory are reused')
+    parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+                        help='output JSON file (default: standard output)')
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if not (stage in STAGES):
+            sys.exit('ERROR: Unknown stage: %s' % stage)
+    try:
+        rows, columns = [int(n) for n in args.matrix.lower().split('x')]
+    except ValueError:
+        sys.exit('ERROR: Invalid matrix size: %s' % args.matrix)
+
+    workDir = args.workDir
+    if workDir == None:
+        workDir = tempfile.mkdtemp(prefix='benchmark-')
+    os.makedirs(workDir, exist_ok=True)
+
+    params = {
+        'series'   : args.series,
+        'params'   : args.params,
+        'slices'   : args.slices,
+        'rows'     : rows,
+        'columns'  : columns,
+        'rois'     : args.rois,
+        'jobs'     : args.jobs,
+        'encoding' : args.encoding,
+        }
+
+    try:
+        dicomDir = os.path.join(workDir, 'dicom')
+        if not os.path.isdir(dicomDir):
+            print('Generating DICOM files in %s...' % dicomDir, file=sys.stderr)
+            generateDICOM(dicomDir, args.series, args.slices, rows, columns, args.params)
+        nrrdDir = os.path.join(workDir, 'nrrd')
+        shutil.rmtree(nrrdDir, ignore_errors=True)
+        print('Generating NRRD files in %s...' % nrrdDir, file=sys.stderr)
+        params['sampledVoxels'] = generateNrrd(nrrdDir, args.params, (columns, rows, args.slices), args.rois)
+
+        results = {}
+        for stage in stages:
+            print('Running %s...' % stage, file=sys.stderr)
+            results[stage] = benchmarkStage(stage, workDir, params, args.repeat)
+    finally:
+        if args.workDir == None:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {
+        'date'       : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'version'    : sourceVersion(),
+        'host'       : platform.node(),
+        'platform'   : platform.platform(),
+        'cpus'       : os.cpu_count(),
+        'python'     : platform.python_version(),
+        'numpy'      : np.__version__,
+        'pydicom'    : pydicom.__version__,
+        'pynrrd'     : nrrd.__version__,
+        'parameters' : params,
+        'stages'     : results,
+        }
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import time
+import fnmatch
+
+import pydicom
+
+from instrumentation import getInstrumentation
+
+
+#  Header-only DICOM access shared by dicom_to_nrrd.py, dicom_list_by_tag.py
+#  and dicom_separate_by_tag.py.
+#
+#  The tools only look at a handful of header attributes to index, filter or
+#  split files. readDICOMHeader() parses just those attributes: it stops before
+#  the pixel data, skips the values of elements that were not requested, and
+#  counts the bytes actually pulled from the file, so the cost of a scan is
+#  proportional to the header size rather than the image size.
+#
+#  Before any parsing, DICOMFileFilter sorts out the files in a directory walk
+#  that are not worth opening with pydicom: file names are checked against
+#  include/exclude patterns, and the 128-byte preamble followed by the "DICM"
+#  magic is checked with a single 132-byte read.
+#
+#  The time spent in readDICOMHeader() is accounted to the 'header parse' stage
+#  (see instrumentation.py).
+
+
+#
+# Convert a tag string (e.g. "0020,000E", "0020000E" or "0x0020000E") to an
+# integer tag
+#
+def tagToInt(tag):
+
+    if isinstance(tag, int):
+        return tag
+    key = tag.replace(',', '').replace('(', '').replace(')', '')
+    return int(key, 16)
+
+
+#
+# Private creator tag of a private tag (e.g. (0051,0010) for (0051,1016)), or
+# None if the tag is not a private data element. The private creator is needed
+# to look up the VR of the private element in an implicit VR file.
+#
+def privateCreatorTag(tag):
+
+    group = tag >> 16
+    element = tag & 0xFFFF
+    if group % 2 == 1 and element >= 0x1000:
+        return (group << 16) | (element >> 8)
+    return None
+
+
+#
+# File wrapper that counts the number of bytes read through it
+#
+class CountingFile(io.RawIOBase):
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.bytesRead = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.bytesRead += len(data)
+        return data
+
+    def readinto(self, b):
+        n = self.fp.readinto(b)
+        self.bytesRead += n
+        return n
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.fp.seek(offset, whence)
+
+    def tell(self):
+        return self.fp.tell()
+
+    def close(self):
+        self.fp.close()
+        super().close()
+
+    @property
+    def name(self):
+        return self.fp.name
+
+
+#
+# Read the DICOM header of 'path'. When 'tags' is given, only those elements
+# (plus the Specific Character Set and the private creators of the private
+# tags) are parsed; other values are skipped.
+# Returns a tuple (dataset, number of bytes read). Raises
+# pydicom.errors.InvalidDicomError if the file is not a DICOM file.
+#
+def readDICOMHeader(path, tags=None):
+
+    specificTags = None
+    if tags is not None:
+        specificTags = [tagToInt(t) for t in tags]
+        creators = [privateCreatorTag(t) for t in specificTags]
+        specificTags = specificTags + [t for t in creators if t != None and not (t in specificTags)]
+
+    start = time.time()
+    with CountingFile(open(path, 'rb')) as fp:
+        dataset = pydicom.dcmread(fp, stop_before_pixels=True,
+                                  specific_tags=specificTags)
+        nbytes = fp.bytesRead
+    getInstrumentation().add('header parse', time.time() - start, 1, nbytes, start)
+
+    return (dataset, nbytes)
+
+
+#
+# Check the 128-byte preamble and the "DICM" magic (DICOM Part 10 file)
+#
+DICOM_PREAMBLE_SIZE = 128
+DICOM_MAGIC = b'DICM'
+
+def hasDICOMMagic(path):
+
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(DICOM_PREAMBLE_SIZE + len(DICOM_MAGIC))
+    except OSError:
+        return False
+    return head[DICOM_PREAMBLE_SIZE:] == DICOM_MAGIC
+
+
+#
+# File name patterns excluded by default: hidden files and DICOMDIR (media
+# directory, not an image)
+#
+DEFAULT_EXCLUDE = ['.*', 'DICOMDIR']
+
+#
+# Pre-filter for the files found in a directory walk
+#   - accept(name) : the file name matches one of the 'include' patterns (if any)
+#                    and none of the 'exclude' patterns (shell-style, e.g. "*.dcm")
+#   - isDICOM(path): the file has the DICOM preamble and magic
+# The files rejected are counted in 'stats' as skipped and invalid, respectively.
+#
+class DICOMFileFilter:
+
+    def __init__(self, include=None, exclude=None):
+        self.include = include or []
+        self.exclude = DEFAULT_EXCLUDE + (exclude or [])
+
+    def accept(self, name, stats=None):
+        name = os.path.basename(name)
+        accepted = True
+        if self.include and not any(fnmatch.fnmatch(name, p) for p in self.include):
+            accepted = False
+        elif any(fnmatch.fnmatch(name, p) for p in self.exclude):
+            accepted = False
+        if not accepted and stats:
+            stats.addSkipped()
+        return accepted
+
+    def isDICOM(self, path, stats=None):
+        if hasDICOMMagic(path):
+            return True
+        if stats:
+            stats.addInvalid()
+        return False
+
+
+#
+# Return the value of 'tag' in 'dataset', or 'default' if it is not present
+#
+def getElementValue(dataset, tag, default=None):
+
+    key = tagToInt(tag)
+    if key in dataset:
+        return dataset[key].value
+    return default
+
+
+#
+# Accumulate the number of files and header bytes read during a scan, and
+# the number of files matched, skipped (by name) and invalid (not DICOM)
+#
+class HeaderScanStats:
+
+    def __init__(self):
+        self.nFiles = 0
+        self.nInvalid = 0
+        self.nBytes = 0
+        self.nSkipped = 0
+        self.nMatched = 0
+
+    def add(self, nbytes):
+        self.nFiles += 1
+        self.nBytes += nbytes
+
+    def addInvalid(self):
+        self.nInvalid += 1
+
+    def addSkipped(self):
+        self.nSkipped += 1
+
+    def addMatched(self):
+        self.nMatched += 1
+
+    def merge(self, other):
+        self.nFiles += other.nFiles
+        self.nInvalid += other.nInvalid
+        self.nBytes += other.nBytes
+        self.nSkipped += other.nSkipped
+        self.nMatched += other.nMatched
+
+    def report(self):
+        average = 0
+        if self.nFiles > 0:
+            average = self.nBytes / self.nFiles
+        print("Header scan: %d files, %d invalid, %d bytes read (%.1f bytes/file)"
+              % (self.nFiles, self.nInvalid, self.nBytes, average))
+        print("Files: %d matched, %d skipped, %d invalid" % (self.nMatched, self.nSkipped, self.nInvalid))
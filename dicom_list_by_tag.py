@@ -5,39 +5,220 @@ import sys
 import os.path
 import argparse
 import shutil
+import threading
+import queue
+import heapq
+import concurrent.futures
 
 import pydicom
 from pydicom.data import get_testdata_files
 
+from dicom_header import readDICOMHeader, HeaderScanStats, DICOMFileFilter
+from file_transfer import FileTransfer, TRANSFER_MODES
+from tag_filter import compileFilter
+from instrumentation import getInstrumentation, configureInstrumentation, finishInstrumentation
+
 
 #
 # Match DICOM attriburtes
 #
-def matchDICOMAttributes(path, tagDict, match):
+def matchDICOMAttributes(path, tagDict, match, stats=None, fileFilter=None, tagFilter=None):
 
     # When match == True, the attributes must match the dictionary value.
     # When match == False, the attributes only need to contain the dictionary values
-    dataset = pydicom.dcmread(path, specific_tags=None)
+    # Only the tags in the dictionary (and in 'tagFilter') are read from the file header.
+    # When 'tagFilter' (see tag_filter.py) is given, the header must also satisfy it.
+    # Files rejected by 'fileFilter' (see DICOMFileFilter) are not parsed.
+    if fileFilter:
+        if not fileFilter.accept(path, stats) or not fileFilter.isDICOM(path, stats):
+            return False
+    tags = list(tagDict.keys())
+    if tagFilter:
+        tags = tags + [t for t in tagFilter.tags if not (t in tagDict)]
+    try:
+        dataset, nbytes = readDICOMHeader(path, tags)
+    except pydicom.errors.InvalidDicomError:
+        getInstrumentation().log("Error: Invalid DICOM file: " + path)
+        if stats:
+            stats.addInvalid()
+        return False
+    if stats:
+        stats.add(nbytes)
+
+    matched = (len(tagDict) == 0)
     for tag in tagDict:
+        if matched:
+            break
         if tag in dataset:
             element = dataset[tag]
             strs = tagDict[tag]
             if match:
                 for s in strs:
                     if s == str(element.value):
-                        return True
+                        matched = True
             else:
                 for s in strs:
                     if s in str(element.value):
-                        return True
-    return False
+                        matched = True
+    if matched and tagFilter:
+        matched = tagFilter.matches(dataset)
+    if matched and stats:
+        stats.addMatched()
+    return matched
+
+
+#
+# Generate (path, file name) of the files in the source directory.
+# The directories and files are visited in sorted order, so the order (and the
+# names given to files with the same name) does not depend on the file system.
+#
+def walkFiles(srcDir, fRecursive):
+
+    for root, dirs, files in os.walk(srcDir):
+        dirs.sort()
+        for file in sorted(files):
+            yield (os.path.join(root, file), file)
+
+        if fRecursive == False:
+            break
+
+
+#
+# Destination path of a file. If the name is taken, a postfix is added.
+# Returns the path and the next postfix.
+#
+def getDestinationPath(dstDir, file, transfer, postfix):
+
+    newfilepath = os.path.join(dstDir, file)
+    if transfer.exists(newfilepath):
+        filename, file_extension = os.path.splitext(file)
+        newfilename = filename + '_%04d' % postfix + file_extension
+        postfix = postfix + 1
+        return (os.path.join(dstDir, newfilename), postfix)
+
+    return (newfilepath, postfix)
+
+
+#
+# List the files one by one (walk, parse, match and copy in sequence)
+#
+def listDICOMFiles(srcDir, dstDir, tagDict, match, fRecursive, transfer, stats, fileFilter=None, tagFilter=None):
+
+    instrumentation = getInstrumentation()
+    instrumentation.startProgress('Files')
+    postfix = 0
+    for filepath, file in instrumentation.iterate('walk', walkFiles(srcDir, fRecursive)):
+        instrumentation.advance()
+        if matchDICOMAttributes(filepath, tagDict, match, stats, fileFilter, tagFilter):
+            dstfilepath, postfix = getDestinationPath(dstDir, file, transfer, postfix)
+            instrumentation.log("%s: %s" % (transfer.verb, filepath))
+            try:
+                transfer.transfer(filepath, dstfilepath)
+            except OSError as e:
+                sys.exit('ERROR: %s' % e)
+    instrumentation.finishProgress()
+
+
+#
+# List the files in a pipeline:
+#   walker thread -> (bounded queue) -> nReaders header readers -> (bounded queue)
+#   -> main thread (destination names) -> nCopiers copy workers
+# The destination names are assigned in the order of the walk, so the result
+# is the same as listDICOMFiles() regardless of the order the headers are read.
+#
+def listDICOMFilesPipelined(srcDir, dstDir, tagDict, match, fRecursive, transfer, stats,
+                            nReaders=4, nCopiers=4, queueSize=256, fileFilter=None, tagFilter=None):
+
+    instrumentation = getInstrumentation()
+    instrumentation.startProgress('Files')
+    pathQueue = queue.Queue(queueSize)
+    resultQueue = queue.Queue(queueSize)
+
+    # Bound the number of files in flight between the walker and the
+    # reordering below (queued, being read, or waiting for an earlier file),
+    # so that a slow file does not let the later results pile up
+    window = threading.BoundedSemaphore(queueSize)
+
+    def walker():
+        for item in enumerate(instrumentation.iterate('walk', walkFiles(srcDir, fRecursive))):
+            window.acquire()
+            pathQueue.put(item)
+        for i in range(nReaders):
+            pathQueue.put(None)
+
+    def reader(readerStats):
+        while True:
+            item = pathQueue.get()
+            if item == None:
+                resultQueue.put(None)
+                return
+            seq, (filepath, file) = item
+            try:
+                matched = matchDICOMAttributes(filepath, tagDict, match, readerStats, fileFilter, tagFilter)
+                resultQueue.put((seq, filepath, file, matched, None))
+            except Exception as e:
+                resultQueue.put((seq, filepath, file, False, e))
+
+    readerStats = [HeaderScanStats() for i in range(nReaders)]
+    threads = [threading.Thread(target=walker, daemon=True)]
+    threads = threads + [threading.Thread(target=reader, args=(rs,), daemon=True) for rs in readerStats]
+    for thread in threads:
+        thread.start()
+
+    # Bound the number of files waiting to be copied
+    slots = threading.BoundedSemaphore(queueSize)
+    errors = []
+    def copied(future):
+        slots.release()
+        if future.exception():
+            errors.append(future.exception())
+
+    postfix = 0
+    nextSeq = 0
+    pending = []
+    nDone = 0
+    with concurrent.futures.ThreadPoolExecutor(nCopiers) as executor:
+        while nDone < nReaders:
+            result = resultQueue.get()
+            if result == None:
+                nDone = nDone + 1
+                continue
+            heapq.heappush(pending, result)
+            # Process the results in the order of the walk
+            while pending and pending[0][0] == nextSeq:
+                seq, filepath, file, matched, error = heapq.heappop(pending)
+                nextSeq = nextSeq + 1
+                window.release()
+                instrumentation.advance()
+                if error:
+                    raise error
+                if errors:
+                    sys.exit('ERROR: %s' % errors[0])
+                if not matched:
+                    continue
+                dstfilepath, postfix = getDestinationPath(dstDir, file, transfer, postfix)
+                transfer.reserve(dstfilepath)
+                instrumentation.log("%s: %s" % (transfer.verb, filepath))
+                if transfer.mode == 'manifest':
+                    transfer.transfer(filepath, dstfilepath)
+                else:
+                    slots.acquire()
+                    executor.submit(transfer.transfer, filepath, dstfilepath).add_done_callback(copied)
+
+    instrumentation.finishProgress()
+    if errors:
+        sys.exit('ERROR: %s' % errors[0])
+
+    for rs in readerStats:
+        stats.merge(rs)
 
 
 def main():
     
     parser = argparse.ArgumentParser(description='List DICOM files based on tags')
-    parser.add_argument('tags', metavar='TAG', type=str, nargs='+',
-                        help='Pairs of DICOM tags and attributes separated by "=" (e.g. "0020,000E=3" means "if the series number is 3")')
+    parser.add_argument('tags', metavar='TAG', type=str, nargs='*',
+                        help='Pairs of DICOM tags and attributes separated by "=" (e.g. "0020,000E=3" means "if the series number is 3"); '
+                        'the file is listed if any of the pairs matches')
     parser.add_argument('src', metavar='SRC_DIR', type=str, nargs=1,
                         help='source directory')
     parser.add_argument('dst', metavar='DST_DIR', type=str, nargs=1,
@@ -50,10 +231,32 @@ def main():
                         help='attributes must exactly match')
     parser.add_argument('-M', dest='move', action='store_const',
                         const=True, default=False,
-                        help='move file instead of copying')
-
+                        help='move file instead of copying (same as "-L move")')
+    parser.add_argument('-L', '--mode', dest='mode', default='copy', choices=TRANSFER_MODES,
+                        help='how to place the files in the destination directory: copy (default), move, hardlink, reflink, symlink, '
+                        'or manifest (only list "SOURCE<TAB>DESTINATION" in DST_DIR/manifest.tsv)')
+    parser.add_argument('-f', '--filter', dest='filter', type=str, default=None, metavar='EXPR',
+                        help='filter expression that the files must also satisfy '
+                        '(e.g. "InversionTime in 100..1000 and 00511016 == R/DIS2D"; see tag_filter.py)')
+    parser.add_argument('--include', dest='include', action='append', default=None, metavar='PATTERN',
+                        help='only process the files whose names match the pattern (e.g. "*.dcm"; can be repeated)')
+    parser.add_argument('--exclude', dest='exclude', action='append', default=None, metavar='PATTERN',
+                        help='skip the files whose names match the pattern (can be repeated; hidden files and DICOMDIR are always skipped)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='number of threads to read the DICOM headers; with more than one, the files are '
+                        'walked, read and copied in a pipeline (default: 1)')
+    parser.add_argument('--copy-jobs', dest='copyJobs', type=int, default=None,
+                        help='number of threads to copy the files in the pipeline (default: same as -j)')
+    parser.add_argument('--queue-size', dest='queueSize', type=int, default=256,
+                        help='maximum number of files waiting in each stage of the pipeline (default: 256)')
+    parser.add_argument('-q', '--quiet', dest='quiet', action='store_const',
+                        const=True, default=False,
+                        help='do not list the files; show a progress bar instead')
+    parser.add_argument('--profile', dest='profile', type=str, default=None, metavar='FILE',
+                        help='report the time spent in each stage, and write the profile and trace to a JSON file')
 
     args = parser.parse_args()
+    configureInstrumentation(args.quiet, args.profile)
     srcdir = args.src
     dstdir = args.dst
     tagDict = {}
@@ -61,6 +264,11 @@ def main():
     # Make the destination directory, if it does not exists.
     os.makedirs(dstdir[0], exist_ok=True)
 
+    mode = args.mode
+    if args.move:
+        mode = 'move'
+    transfer = FileTransfer(mode, os.path.join(dstdir[0], 'manifest.tsv'))
+
     # Convert tags (e.g. "0020,000E=XXX") to dictionary ( {0x0020000E: XXXX})
     for tag in args.tags:
         pair = tag.split('=')
@@ -73,29 +281,29 @@ def main():
         else:
             tagDict[tagNum] = (pair[1],)
 
-    postfix = 0
-    for root, dirs, files in os.walk(srcdir[0]):
-        for file in files:
-            filepath = os.path.join(root, file)
-            if matchDICOMAttributes(filepath, tagDict, args.match):
-                newfilepath = os.path.join(dstdir[0], file)
-                dstfilepath = ''
-                if os.path.exists(newfilepath):
-                    filename, file_extension = os.path.splitext(file)
-                    newfilename = filename + '_%04d' % postfix + file_extension
-                    postfix = postfix + 1
-                    dstfilepath = os.path.join(dstdir[0], newfilename)
-                else:
-                    dstfilepath = os.path.join(dstdir[0], file)
-                if args.move:
-                    print("Moving: %s" % filepath)
-                    shutil.move(filepath, dstfilepath)
-                else:
-                    print("Copying: %s" % filepath)
-                    shutil.copy(filepath, dstfilepath)
-                
-        if args.recursive == False:
-            break
+    tagFilter = None
+    if args.filter:
+        try:
+            tagFilter = compileFilter(args.filter)
+        except ValueError as e:
+            sys.exit('ERROR: %s' % e)
+    elif len(tagDict) == 0:
+        sys.exit('ERROR: No tag or filter expression is given.')
+
+    fileFilter = DICOMFileFilter(args.include, args.exclude)
+    stats = HeaderScanStats()
+    if args.jobs > 1:
+        nCopiers = args.copyJobs
+        if nCopiers == None:
+            nCopiers = args.jobs
+        listDICOMFilesPipelined(srcdir[0], dstdir[0], tagDict, args.match, args.recursive, transfer, stats,
+                                args.jobs, nCopiers, args.queueSize, fileFilter, tagFilter)
+    else:
+        listDICOMFiles(srcdir[0], dstdir[0], tagDict, args.match, args.recursive, transfer, stats, fileFilter, tagFilter)
+
+    transfer.close()
+    stats.report()
+    finishInstrumentation(args.profile)
     
 if __name__ == "__main__":
     main()
@@ -10,26 +10,43 @@ import copy
 import pydicom
 from pydicom.data import get_testdata_files
 
+from dicom_header import readDICOMHeader, HeaderScanStats, DICOMFileFilter
+from file_transfer import FileTransfer, TRANSFER_MODES
+from instrumentation import getInstrumentation, configureInstrumentation, finishInstrumentation
+
 
 #
-# Match DICOM attriburtes
+# Get the values of multiple tags from one header read. Returns a list of the
+# values (None for missing tags), or None if the file is not a DICOM file.
 #
-def getDICOMAttribute(path, tag):
+def getDICOMAttributes(path, tags, stats=None, fileFilter=None):
 
     dataset = None
+    if fileFilter and not fileFilter.isDICOM(path, stats):
+        getInstrumentation().log("Error: Invalid DICOM file: " + path)
+        return None
     try:
-        dataset = pydicom.dcmread(path, specific_tags=None)
+        dataset, nbytes = readDICOMHeader(path, tags)
     except pydicom.errors.InvalidDicomError:
-        print("Error: Invalid DICOM file: " + path)
-        return None
-    
-    key = tag.replace(',', '')
-    if key in dataset:
-        element = dataset[tag.replace(',', '')]
-        return element.value
-    else:
+        getInstrumentation().log("Error: Invalid DICOM file: " + path)
+        if stats:
+            stats.addInvalid()
         return None
 
+    if stats:
+        stats.add(nbytes)
+        stats.addMatched()
+
+    values = []
+    for tag in tags:
+        key = tag.replace(',', '')
+        if key in dataset:
+            values.append(dataset[key].value)
+        else:
+            values.append(None)
+
+    return values
+
 #
 # Convert attribute to folder name (Remove special characters that cannot be
 # included in a path name)
@@ -58,7 +75,7 @@ def loadDirectoryNames(filename):
 #
 # extract DICOM files by Tag, and return the list of attributes ( = names of subfoders)
 #
-def extractDICOMByTag(srcDir, dstDir, tagList, fRecursive, fMove, dirDict, fPreserve):
+def extractDICOMByTag(srcDir, dstDir, tagList, fRecursive, transfer, dirDict, fPreserve, stats=None, fileFilter=None):
 
     postfix = 0
     attrList = []
@@ -74,14 +91,20 @@ def extractDICOMByTag(srcDir, dstDir, tagList, fRecursive, fMove, dirDict, fPres
 
     print("Processing directory: %s..." % srcDir)
     
-    for root, dirs, files in os.walk(srcDir):
+    instrumentation = getInstrumentation()
+    instrumentation.startProgress('Files')
+    for root, dirs, files in instrumentation.iterate('walk', os.walk(srcDir)):
         for file in files:
+            instrumentation.advance()
             srcFilePath = os.path.join(root, file)
+            if fileFilter and not fileFilter.accept(file, stats):
+                continue
           
-            attr = str(getDICOMAttribute(srcFilePath, tag))
-            if attr == None:
-                print("The image does not contain tag: %s" % tag)
+            # Files that are not DICOM are skipped (and counted as invalid)
+            values = getDICOMAttributes(srcFilePath, [tag], stats, fileFilter)
+            if values == None:
                 continue
+            attr = str(values[0])
             newFolderName = removeSpecialCharacter(str(attr))
             if dirDict:
                 if attr in dirDict:
@@ -105,33 +128,100 @@ def extractDICOMByTag(srcDir, dstDir, tagList, fRecursive, fMove, dirDict, fPres
                 attrList.append(attr)
 
             ## Create the destination folder, if it does not exist.
-            os.makedirs(dstSubDirPath, exist_ok=True)
+            if transfer.mode != 'manifest':
+                os.makedirs(dstSubDirPath, exist_ok=True)
             
-            if os.path.exists(dstFilePath):
+            if transfer.exists(dstFilePath):
                 filename, file_extension = os.path.splitext(file)
                 newfilename = filename + '_%04d' % postfix + file_extension
                 postfix = postfix + 1
                 dstFilePath = os.path.join(dstSubDirPath, newfilename)
-            if fMove:
-                print("Moving: %s -> %s" % (srcFilePath, dstFilePath))
-                shutil.move(srcFilePath, dstFilePath)
-            else:
-                print("Copying: %s -> %s" % (srcFilePath, dstFilePath))
-                shutil.copy(srcFilePath, dstFilePath)
+            instrumentation.log("%s: %s -> %s" % (transfer.verb, srcFilePath, dstFilePath))
+            try:
+                transfer.transfer(srcFilePath, dstFilePath)
+            except OSError as e:
+                sys.exit('ERROR: %s' % e)
                 
         if fRecursive == False:
             break
+    instrumentation.finishProgress()
 
     # Call extractDICOMByTag() recursively
     # (NOTE: the fRecursive flag is for searching the source directory, and does not
-    #  affect the call of extractDICOMByTag().)
+    #  affect the call of extractDICOMByTag(). The files (or links) placed in the
+    #  subfolders are moved to the next level.)
     for attr in attrList:
         newDirName = removeSpecialCharacter(attr)
         newSrcDir= os.path.join(dstDir, newDirName)
         newDstDir= os.path.join(dstDir, newDirName)
-        extractDICOMByTag(newSrcDir, newDstDir, tags, fRecursive, True, dirDict, fRecursive)
+        extractDICOMByTag(newSrcDir, newDstDir, tags, fRecursive, FileTransfer('move'), dirDict, fRecursive, stats, fileFilter)
 
         
+#
+# Extract DICOM files by multiple tags in a single pass
+# Each file is parsed once for all tags, and placed directly in the nested
+# destination folder (DST_DIR/<attribute of tag 1>/<attribute of tag 2>/...).
+# With fPreserve, the folders are created under the relative path of the
+# source folder (DST_DIR/<relative path>/<attribute of tag 1>/...).
+#
+def extractDICOMByTagsSinglePass(srcDir, dstDir, tags, fRecursive, transfer, dirDict, fPreserve, stats=None, fileFilter=None):
+
+    postfix = 0
+
+    print("Processing directory: %s..." % srcDir)
+
+    instrumentation = getInstrumentation()
+    instrumentation.startProgress('Files')
+    for root, dirs, files in instrumentation.iterate('walk', os.walk(srcDir)):
+        for file in files:
+            instrumentation.advance()
+            srcFilePath = os.path.join(root, file)
+            if fileFilter and not fileFilter.accept(file, stats):
+                continue
+
+            # Files that are not DICOM are skipped (and counted as invalid)
+            values = getDICOMAttributes(srcFilePath, tags, stats, fileFilter)
+            if values == None:
+                continue
+
+            folderNames = []
+            for value in values:
+                attr = str(value)
+                newFolderName = removeSpecialCharacter(attr)
+                if dirDict:
+                    if attr in dirDict:
+                        newFolderName = dirDict[attr]
+                folderNames.append(newFolderName)
+
+            if fPreserve:
+                # Preserve the input folder structure, (when used with the recursive option)
+                relPath = os.path.relpath(root, srcDir)
+                dstSubDirPath = os.path.join(dstDir, relPath, *folderNames)
+            else:
+                # Use a flat folder structure under the destinatio folder
+                dstSubDirPath = os.path.join(dstDir, *folderNames)
+            dstFilePath = os.path.join(dstSubDirPath, file)
+
+            ## Create the destination folder, if it does not exist.
+            if transfer.mode != 'manifest':
+                os.makedirs(dstSubDirPath, exist_ok=True)
+
+            if transfer.exists(dstFilePath):
+                filename, file_extension = os.path.splitext(file)
+                newfilename = filename + '_%04d' % postfix + file_extension
+                postfix = postfix + 1
+                dstFilePath = os.path.join(dstSubDirPath, newfilename)
+            instrumentation.log("%s: %s -> %s" % (transfer.verb, srcFilePath, dstFilePath))
+            try:
+                transfer.transfer(srcFilePath, dstFilePath)
+            except OSError as e:
+                sys.exit('ERROR: %s' % e)
+
+        if fRecursive == False:
+            break
+    instrumentation.finishProgress()
+
+
 def main():
     
     parser = argparse.ArgumentParser(description='Extract DICOM files based on tags')
@@ -149,10 +239,26 @@ def main():
                         help=' preserve the input folder structure (should be used with -r)')
     parser.add_argument('-M', dest='move', action='store_const',
                         const=True, default=False,
-                        help='move file instead of copying')
+                        help='move file instead of copying (same as "-L move")')
+    parser.add_argument('-L', '--mode', dest='mode', default='copy', choices=TRANSFER_MODES,
+                        help='how to place the files in the destination directory: copy (default), move, hardlink, reflink, symlink, '
+                        'or manifest (only list "SOURCE<TAB>DESTINATION" in DST_DIR/manifest.tsv; requires -s for multiple tags)')
+    parser.add_argument('-s', '--single-pass', dest='singlePass', action='store_const',
+                        const=True, default=False,
+                        help='read all tags from each file at once and place each file directly in its final folder')
+    parser.add_argument('--include', dest='include', action='append', default=None, metavar='PATTERN',
+                        help='only process the files whose names match the pattern (e.g. "*.dcm"; can be repeated)')
+    parser.add_argument('--exclude', dest='exclude', action='append', default=None, metavar='PATTERN',
+                        help='skip the files whose names match the pattern (can be repeated; hidden files and DICOMDIR are always skipped)')
     parser.add_argument('-d', dest='dic', default=None, help='dictionary for directory names (in a space-separated-variables file)')
+    parser.add_argument('-q', '--quiet', dest='quiet', action='store_const',
+                        const=True, default=False,
+                        help='do not list the files; show a progress bar instead')
+    parser.add_argument('--profile', dest='profile', type=str, default=None, metavar='FILE',
+                        help='report the time spent in each stage, and write the profile and trace to a JSON file')
 
     args = parser.parse_args()
+    configureInstrumentation(args.quiet, args.profile)
     srcdir = args.src
     dstdir = args.dst
     tagDict = {}
@@ -166,7 +272,22 @@ def main():
     # Make the destination directory, if it does not exists.
     os.makedirs(dstdir[0], exist_ok=True)
 
-    extractDICOMByTag(srcdir[0], dstdir[0], args.tags, args.recursive, args.move, dirDict, args.preserve)
+    mode = args.mode
+    if args.move:
+        mode = 'move'
+    if mode == 'manifest' and len(args.tags) > 1 and not args.singlePass:
+        sys.exit('ERROR: The manifest mode requires the single-pass mode (-s) for multiple tags.')
+    transfer = FileTransfer(mode, os.path.join(dstdir[0], 'manifest.tsv'))
+
+    fileFilter = DICOMFileFilter(args.include, args.exclude)
+    stats = HeaderScanStats()
+    if args.singlePass:
+        extractDICOMByTagsSinglePass(srcdir[0], dstdir[0], args.tags, args.recursive, transfer, dirDict, args.preserve, stats, fileFilter)
+    else:
+        extractDICOMByTag(srcdir[0], dstdir[0], args.tags, args.recursive, transfer, dirDict, args.preserve, stats, fileFilter)
+    transfer.close()
+    stats.report()
+    finishInstrumentation(args.profile)
 
         
 
@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse, sys, shutil, os, logging
+import tempfile
+import json
+import multiprocessing
+import itertools
+import concurrent.futures
+import time
 import numpy as np
 import sqlite3
 import pydicom
 import nrrd
 
+from dicom_header import readDICOMHeader, HeaderScanStats, DICOMFileFilter, getElementValue
+from tag_filter import compileFilter, indexComponents
+from nrrd_stream import NrrdStreamWriter, DATA_FILE_EXTENSIONS, NUMPY_TO_NRRD_TYPES
+from instrumentation import getInstrumentation, configureInstrumentation, collectInstrumentation, finishInstrumentation
+from run_journal import RunJournal, inputHash
+
 
 #  Usage:
 #
@@ -41,30 +53,36 @@ import nrrd
 
 #
 # Match DICOM attriburtes
+# (Returns a tuple of the values of the tags as strings)
 #
-def getDICOMAttribute(path, tags):
+def getDICOMAttribute(path, tags, stats=None, fileFilter=None):
 
     dataset = None
+    if fileFilter and not fileFilter.isDICOM(path, stats):
+        getInstrumentation().log("Error: Invalid DICOM file: " + path)
+        return None
     try:
-        dataset = pydicom.dcmread(path, specific_tags=None)
+        dataset, nbytes = readDICOMHeader(path, tags)
     except pydicom.errors.InvalidDicomError:
-        print("Error: Invalid DICOM file: " + path)
+        getInstrumentation().log("Error: Invalid DICOM file: " + path)
+        if stats:
+            stats.addInvalid()
         return None
 
-    insertStr = ''
+    if stats:
+        stats.add(nbytes)
+        stats.addMatched()
+
+    values = []
     for tag in tags:
         key = tag.replace(',', '')
         value = ''
         if key in dataset:
             element = dataset[key]
             value = element.value
-            
-        if insertStr == '':
-            insertStr = "'" + str(value) + "'"
-        else:
-            insertStr = insertStr + ',' + "'" + str(value) + "'"
+        values.append(str(value))
                 
-    return insertStr;
+    return tuple(values)
 
 
 #
@@ -80,63 +98,718 @@ def removeSpecialCharacter(v):
 
 
 #
-# Concatenate column names
+# DICOM tags always stored in the file index, in addition to the tags
+# specified by the user. Storing the commonly used attributes lets a
+# persistent index (--index) be regrouped by other tags without re-parsing.
 #
-def concatColNames(tags):
+INDEX_TAGS = [
+    '00080008', # ImageType
+    '00080032', # AcquisitionTime
+    '0008103E', # SeriesDescription
+    '00100010', # PatientsName
+    '00180050', # SliceThickness
+    '00180080', # RepetitionTime
+    '00180081', # EchoTime
+    '00180082', # InversionTime
+    '00180086', # EchoNumbers
+    '00180091', # EchoTrainLength
+    '0020000E', # SeriesInstanceUID
+    '00200010', # StudyID
+    '00200011', # SeriesNumber
+    '00200013', # InstanceNumber
+    '00200032', # ImagePositionPatient
+    '00200037', # ImageOrientationPatient
+    '00201041', # SliceLocation
+    '00280010', # Rows
+    '00280011', # Columns
+    '00280030', # PixelSpacing
+    '00280100', # BitsAllocated
+    '00281052', # RescaleIntercept
+    '00281053', # RescaleSlope
+    '0051100F', # Coil element (Siemens)
+    '00511016', # Real/Imaginary (Siemens)
+    ]
+
 
-    r = ''
-    for tag in tags:
-        key = tag.replace(',', '')
-        if r == '':
-            r = 'x' + key + ' text'
-        else:
-            r = r + ',' + 'x' + key + ' text'
-    return r;
-    
 #
-# Build a file path database based on the DICOM tags
+# Column name for a DICOM tag
+# Note: We add prefix 'x' to the DICOM tag as the DICOM tags are recognized as intenger
+#       by SQLight
 #
-def buildFilePathDBByTags(con, srcDir, tags, fRecursive=True):
+def tagColumnName(tag):
 
-    # Create a table
-    con.execute('CREATE TABLE dicom (' + concatColNames(tags) + ',path text)')
+    return 'x' + tag.replace(',', '').upper()
+
+
+#
+# Extract the attributes of a chunk of files (Called in a worker process.)
+# 'files' is a list of (path, mtime, size). Returns a list of rows for the
+# file index, a list of the files that are not DICOM, the header scan
+# statistics and the instrumentation data.
+#
+def getDICOMAttributeChunk(args):
+
+    files, tags, fileFilter = args
+    stats = HeaderScanStats()
+    rows = []
+    invalid = []
+    with collectInstrumentation() as instrumentation:
+        for path, mtime, size in files:
+            values = getDICOMAttribute(path, tags, stats, fileFilter)
+            if values == None:
+                instrumentation.log("Could not obtain attributes for %s" % path)
+                invalid.append((path, mtime, size))
+                continue
+            rows.append((path, mtime, size) + values)
+
+    return (rows, invalid, stats, instrumentation.data())
+
+
+#
+# Generate a list of (path, mtime, size) for the files in the source directory
+# (The files whose names are rejected by 'fileFilter' are skipped.)
+#
+def listFiles(srcDir, fRecursive=True, fileFilter=None, stats=None):
 
-    filePathList = []
-    postfix = 0
-    attrList = []
-    
-    print("Processing directory: %s..." % srcDir)
-    
     for root, dirs, files in os.walk(srcDir):
         for file in files:
-            srcFilePath = os.path.join(root, file)
-            insertStr = getDICOMAttribute(srcFilePath, tags)
-            if insertStr == None:
-                print("Could not obtain attributes for %s" % srcFilePath)
+            if fileFilter and not fileFilter.accept(file, stats):
                 continue
-            else:
-                # Add the file path
-                insertStr = insertStr + ',' + "'" + srcFilePath + "'"
-                con.execute('INSERT INTO dicom VALUES (' + insertStr + ')')
+            path = os.path.join(root, file)
+            st = os.stat(path)
+            yield (path, st.st_mtime_ns, st.st_size)
 
-    
         if fRecursive == False:
             break
+
+
+#
+# Split a list into chunks
+#
+def splitChunks(items, chunkSize=256):
+
+    for i in range(0, len(items), chunkSize):
+        yield items[i:i+chunkSize]
+
+
+#
+# SQL condition that selects the files under the source directory from the
+# file index. ('prefix' is the absolute path of the source directory ending
+# with a separator.)
+#
+def sourceDirCondition(prefix, fRecursive=True):
+
+    quoted = "'" + prefix.replace("'", "''") + "'"
+    cond = 'substr(path, 1, %d) == %s' % (len(prefix), quoted)
+    if fRecursive == False:
+        cond = cond + " AND instr(substr(path, %d), '%s') == 0" % (len(prefix) + 1, os.sep)
+    return cond
+
+
+#
+# Build a file path database based on the DICOM tags
+#
+# The files are recorded in the 'dicom_index' table, keyed by path together
+# with their modification time and size. Only the files that are new or
+# modified since the last call, or that lack a requested tag, are parsed;
+# the others are taken from the index as is. This matters when 'con' is a
+# persistent database (see the --index option). The files under 'srcDir' are
+# then exposed as the temporary view 'dicom'.
+# (When nJobs > 1, the headers are parsed in a pool of nJobs processes.)
+# Files rejected by 'fileFilter' by name are not indexed; those without the
+# DICOM magic are recorded as invalid without being parsed.
+#
+def buildFilePathDBByTags(con, srcDir, tags, fRecursive=True, nJobs=1, fileFilter=None):
+
+    # Create the tables
+    con.execute('CREATE TABLE IF NOT EXISTS dicom_index (path text PRIMARY KEY, mtime integer, size integer)')
+    con.execute('CREATE TABLE IF NOT EXISTS dicom_invalid (path text PRIMARY KEY, mtime integer, size integer)')
+
+    # Add a column for each tag that is not in the index yet.
+    # (The new column is NULL for the files indexed before.)
+    columns = [r[1].upper() for r in con.execute('PRAGMA table_info(dicom_index)')][3:]
+    for tag in INDEX_TAGS + tags:
+        colName = tagColumnName(tag)
+        if not (colName.upper() in columns):
+            con.execute('ALTER TABLE dicom_index ADD COLUMN ' + colName + ' text')
+            columns.append(colName.upper())
+    indexTags = [c[1:] for c in columns]
+
+    insertSQL = ('INSERT OR REPLACE INTO dicom_index (path,mtime,size,' + ','.join(columns) + ') VALUES ('
+                 + ','.join(['?'] * (len(columns) + 3)) + ')')
+    invalidSQL = 'INSERT OR REPLACE INTO dicom_invalid (path,mtime,size) VALUES (?,?,?)'
+
+    prefix = os.path.join(os.path.abspath(srcDir), '')
+    srcCond = sourceDirCondition(prefix, fRecursive)
+
+    # Load the files in the index
+    indexed = {}
+    for path, mtime, size in con.execute('SELECT path,mtime,size FROM dicom_index WHERE ' + srcCond):
+        indexed[path] = (mtime, size)
+    for path, mtime, size in con.execute('SELECT path,mtime,size FROM dicom_invalid WHERE ' + srcCond):
+        indexed[path] = (mtime, size)
+    incomplete = set()
+    nullCond = ' OR '.join([tagColumnName(tag) + ' IS NULL' for tag in tags])
+    for (path,) in con.execute('SELECT path FROM dicom_index WHERE (' + srcCond + ') AND (' + nullCond + ')'):
+        incomplete.add(path)
+
+    print("Processing directory: %s..." % srcDir)
+
+    # List the files to be parsed
+    instrumentation = getInstrumentation()
+    stats = HeaderScanStats()
+    files = []
+    nFiles = 0
+    for path, mtime, size in instrumentation.iterate('walk', listFiles(prefix, fRecursive, fileFilter, stats)):
+        nFiles = nFiles + 1
+        if indexed.pop(path, None) != (mtime, size) or path in incomplete:
+            files.append((path, mtime, size))
+
+    # Remove the files that no longer exist
+    removed = [(path,) for path in indexed]
+    con.executemany('DELETE FROM dicom_index WHERE path == ?', removed)
+    con.executemany('DELETE FROM dicom_invalid WHERE path == ?', removed)
+
+    print("Index: %d files, %d to be parsed, %d removed" % (nFiles, len(files), len(removed)))
+    instrumentation.count('files indexed', nFiles)
+    instrumentation.count('files parsed', len(files))
+
+    chunks = ((chunk, indexTags, fileFilter) for chunk in splitChunks(files))
+
+    def insertChunk(result):
+        rows, invalid, chunkStats, chunkData = result
+        with instrumentation.stage('DB insert', len(rows) + len(invalid)):
+            con.executemany('DELETE FROM dicom_invalid WHERE path == ?', [(r[0],) for r in rows])
+            con.executemany(insertSQL, rows)
+            con.executemany('DELETE FROM dicom_index WHERE path == ?', [(r[0],) for r in invalid])
+            con.executemany(invalidSQL, invalid)
+        stats.merge(chunkStats)
+        instrumentation.merge(chunkData)
+        instrumentation.advance(len(rows) + len(invalid))
+
+    # The rows are inserted in a single transaction, committed at the end.
+    instrumentation.startProgress('Headers', len(files))
+    if nJobs > 1 and len(files) > 0:
+        with multiprocessing.Pool(nJobs) as pool:
+            for result in pool.imap_unordered(getDICOMAttributeChunk, chunks):
+                insertChunk(result)
+    else:
+        for result in map(getDICOMAttributeChunk, chunks):
+            insertChunk(result)
         
-    con.commit()
+    with instrumentation.stage('DB insert', 0):
+        con.commit()
+    instrumentation.finishProgress()
+    stats.report()
 
+    # Files under the source directory
+    con.execute('DROP VIEW IF EXISTS temp.dicom')
+    con.execute('CREATE TEMP VIEW dicom AS SELECT * FROM dicom_index WHERE ' + srcCond)
 
-def exportNrrd(filelist, dst=None, filename=None):
-    # Obtain the image info from the first image
 
-    nSlices = len(filelist)
+#
+# Restrict the temporary view 'dicom' to the files that satisfy 'tagFilter'
+# (see tag_filter.py). The expression is evaluated at once on the columns of
+# the index; the tags in the expression must have been indexed.
+#
+def selectFilesByFilter(con, tagFilter):
+
+    tags = sorted(tagFilter.tags)
+    rows = con.execute('SELECT path,' + ','.join([tagColumnName('%08X' % t) for t in tags])
+                       + ' FROM dicom').fetchall()
+    columns = {}
+    for i, tag in enumerate(tags):
+        columns[tag] = [r[i+1] if r[i+1] != None else '' for r in rows]
+    selected = tagFilter.evaluate(columns)
+
+    con.execute('DROP TABLE IF EXISTS temp.dicom_selected')
+    con.execute('CREATE TEMP TABLE dicom_selected (path text PRIMARY KEY)')
+    con.executemany('INSERT INTO dicom_selected (path) VALUES (?)',
+                    [(r[0],) for r, s in zip(rows, selected) if s])
+    con.execute('DROP VIEW IF EXISTS temp.dicom')
+    con.execute('CREATE TEMP VIEW dicom AS SELECT * FROM dicom_index WHERE path IN (SELECT path FROM temp.dicom_selected)')
+
+    print("Filter: %d of %d files selected" % (int(selected.sum()), len(rows)))
+
+
+#
+# NumPy data type of the stored pixel values
+#
+def pixelDataType(bitsAllocated, pixelRepresentation):
+
+    if pixelRepresentation == 1:
+        return np.dtype('int%d' % bitsAllocated)
+    return np.dtype('uint%d' % bitsAllocated)
+
+
+#
+# Data type of the rescaled pixel values (U = m*SV + b) for a list of slices.
+# This is the type that "SV*m + b" would have for the stored values, except that
+# a negative intercept always gives 'int16'.
+#
+def rescaledDataType(slices):
+
+    dtype = None
+    for sl in slices:
+        sv = np.zeros(0, dtype=pixelDataType(sl['bitsAllocated'], sl['pixelRepresentation']))
+        if sl['rescaleIntercept'] < 0:
+            t = np.dtype('int16')
+        else:
+            t = (sv*sl['rescaleSlope'] + sl['rescaleIntercept']).dtype
+        if dtype == None:
+            dtype = t
+        else:
+            dtype = np.result_type(dtype, t)
+
+    return dtype
+
+
+# Output data types (see outputDataType())
+RESCALE_MODES = ['rescaled', 'exact', 'stored']
+
+# Integer types, from the narrowest
+INTEGER_TYPES = ['uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'uint64', 'int64']
+
+#
+# Narrowest integer type that holds all values in [low, high] (None if none)
+#
+def narrowestIntegerType(low, high):
+
+    for name in INTEGER_TYPES:
+        info = np.iinfo(name)
+        if info.min <= low and high <= info.max:
+            return np.dtype(name)
+    return None
+
+
+#
+# Narrowest integer type that holds the rescaled values (U = m*SV + b) of all
+# slices exactly, from the range of the stored values (BitsStored and
+# PixelRepresentation) and the slope/intercept; None if the slope or the
+# intercept of a slice is not an integer.
+#
+def exactDataType(slices):
+
+    low = None
+    high = None
+    for sl in slices:
+        slope = float(sl['rescaleSlope'])
+        intercept = float(sl['rescaleIntercept'])
+        if not (slope.is_integer() and intercept.is_integer()):
+            return None
+        bits = sl['bitsStored']
+        if sl['pixelRepresentation'] == 1:
+            values = [-(2**(bits-1)), 2**(bits-1) - 1]
+        else:
+            values = [0, 2**bits - 1]
+        values = [int(slope) * v + int(intercept) for v in values]
+        low = min(values + ([low] if low != None else []))
+        high = max(values + ([high] if high != None else []))
+
+    return narrowestIntegerType(low, high)
+
+
+#
+# Data type of the output image for a list of slices and the rescale mode:
+#   'rescaled' : the rescaled values, in the type given by rescaledDataType()
+#   'exact'    : the rescaled values, in the narrowest integer type that holds
+#                them exactly (or 'float64' if the slope or intercept is not an
+#                integer)
+#   'stored'   : the stored values, in their own type. The slope and intercept
+#                are recorded in the header ('RescaleSlope' and
+#                'RescaleIntercept'), and are not applied. (If they differ
+#                between the slices, as 'exact'.)
+# The 'type' field of 'header' is set. Returns the data type and the slices
+# to be decoded (with the slope/intercept to be applied).
+#
+def outputDataType(slices, header, rescale='rescaled'):
+
+    dtype = None
+    if rescale == 'stored':
+        pairs = set([(float(sl['rescaleSlope']), float(sl['rescaleIntercept'])) for sl in slices])
+        if len(pairs) == 1:
+            slope, intercept = pairs.pop()
+            dtype = np.result_type(*[pixelDataType(sl['bitsAllocated'], sl['pixelRepresentation']) for sl in slices])
+            slices = [dict(sl, rescaleSlope=1, rescaleIntercept=0) for sl in slices]
+            header['RescaleSlope'] = repr(slope)
+            header['RescaleIntercept'] = repr(intercept)
+        else:
+            print('Warning: The rescale slope/intercept differ between the slices. Rescaling the values.')
+            rescale = 'exact'
+    if rescale == 'exact':
+        dtype = exactDataType(slices)
+        if dtype is None:
+            dtype = np.dtype('float64')
+    if dtype is None:
+        dtype = rescaledDataType(slices)
+
+    header['type'] = NUMPY_TO_NRRD_TYPES[np.dtype(dtype).newbyteorder('<').str[1:]]
+    return (dtype, slices)
+
+
+# Uncompressed little endian transfer syntaxes, for which the pixel data can be
+# copied to the volume without decoding.
+NATIVE_TRANSFER_SYNTAXES = [
+    '1.2.840.10008.1.2',   # Implicit VR Little Endian
+    '1.2.840.10008.1.2.1', # Explicit VR Little Endian
+    ]
+
+# Prefix of the stages for the decoding of each transfer syntax (see
+# instrumentation.py)
+DECODE_STAGE_PREFIX = 'pixel decode: '
+
+#
+# Name of a transfer syntax (e.g. 'JPEG 2000 Image Compression')
+#
+def transferSyntaxName(uid):
+
+    if uid == '':
+        return 'unknown'
+    return pydicom.uid.UID(uid).name
+
+
+#
+# Keep the 'bitsStored' low bits of the stored values, as pixel_array does: the
+# bits above are cleared (unsigned) or replaced by the sign bit (signed).
+#
+def maskStoredBits(pixelArray, bitsStored, pixelRepresentation):
+
+    shift = pixelArray.dtype.itemsize * 8 - bitsStored
+    if shift <= 0:
+        return pixelArray
+    if pixelRepresentation == 1:
+        return (pixelArray << shift) >> shift
+    return pixelArray & pixelArray.dtype.type((1 << bitsStored) - 1)
+
+
+#
+# Raised when the rescaled values of a slice do not fit in the integer type of
+# the output
+#
+class PixelRangeError(ValueError):
+    pass
+
+
+#
+# Check that the rescaled values (U = m*SV + b) of the stored values fit in the
+# integer type 'dtype' (the float types always fit)
+#
+def checkPixelRange(pixelArray, slope, intercept, dtype):
+
+    if dtype.kind == 'f' or pixelArray.size == 0:
+        return
+    values = [float(pixelArray.min()) * float(slope) + float(intercept),
+              float(pixelArray.max()) * float(slope) + float(intercept)]
+    info = np.iinfo(dtype)
+    if min(values) < info.min or max(values) > info.max:
+        raise PixelRangeError('The rescaled values (%g to %g) do not fit in %s' % (min(values), max(values), dtype))
+
+
+#
+# Decode the pixel data of a slice into 'plane' (a (columns, rows) view of the
+# volume), and apply the rescale slope/intercept in place. Raises
+# PixelRangeError if the values do not fit in the type of the plane.
+#
+def decodeSlice(sl, plane):
+
+    instrumentation = getInstrumentation()
+    start = time.time()
+    dataset = pydicom.dcmread(sl['path'])
+
+    transferSyntax = dataset.file_meta.get('TransferSyntaxUID', '')
+    samplesPerPixel = dataset.get('SamplesPerPixel', 1)
+    numberOfFrames = int(dataset.get('NumberOfFrames', 1) or 1)
+    if (transferSyntax in NATIVE_TRANSFER_SYNTAXES and samplesPerPixel == 1 and numberOfFrames == 1
+        and sl['bitsAllocated'] in (8, 16, 32)):
+        # Use the pixel data buffer as is (the bits above BitsStored are masked)
+        dtype = pixelDataType(sl['bitsAllocated'], sl['pixelRepresentation']).newbyteorder('<')
+        pixelArray = np.frombuffer(dataset.PixelData, dtype=dtype, count=sl['rows']*sl['columns'])
+        pixelArray = pixelArray.reshape((sl['rows'], sl['columns']))
+    else:
+        pixelArray = dataset.pixel_array
+    pixelArray = maskStoredBits(pixelArray, sl['bitsStored'], sl['pixelRepresentation'])
+    elapsed = time.time() - start
+    instrumentation.add('pixel decode', elapsed, 1, pixelArray.nbytes, start)
+    instrumentation.add(DECODE_STAGE_PREFIX + transferSyntaxName(transferSyntax), elapsed, 1, pixelArray.nbytes)
+
+    start = time.time()
+    slope = sl['rescaleSlope']
+    intercept = sl['rescaleIntercept']
+    checkPixelRange(pixelArray, slope, intercept, plane.dtype)
+    if slope == 1 and intercept == 0:
+        plane[...] = np.transpose(pixelArray)
+    elif plane.dtype.kind == 'f':
+        plane[...] = np.transpose(pixelArray)
+        plane *= slope
+        plane += intercept
+    else:
+        # Integer output: rescale in floating point and truncate, one slice at a time
+        plane[...] = np.transpose(pixelArray)*slope + intercept
+    instrumentation.add('assembly', time.time() - start, 1, plane.nbytes, start)
+
+
+#
+# Decode the slices into their planes in the volume ('planeOf(i)' returns the
+# (columns, rows) view for slices[i]). The slices in compressed transfer
+# syntaxes (JPEG, JPEG-LS, JPEG 2000, RLE, ...) are decoded in a pool of
+# nThreads threads, as the codecs release the GIL; each thread writes
+# directly into the plane of its slice. The slices in the native transfer
+# syntaxes are only copied, in the calling thread.
+#
+def decodeSlices(slices, planeOf, nThreads=1):
+
+    compressed = []
+    for i, sl in enumerate(slices):
+        if nThreads > 1 and not (sl['transferSyntax'] in NATIVE_TRANSFER_SYNTAXES):
+            compressed.append(i)
+        else:
+            decodeSlice(sl, planeOf(i))
+
+    if len(compressed) > 0:
+        with concurrent.futures.ThreadPoolExecutor(nThreads) as executor:
+            futures = [executor.submit(decodeSlice, slices[i], planeOf(i)) for i in compressed]
+            for future in futures:
+                future.result()
+
+
+#
+# Report the decoding throughput of each transfer syntax (accumulated in the
+# instrumentation; the time is summed over the threads)
+#
+def reportDecodeThroughput():
+
+    stages = getInstrumentation().summary()['stages']
+    for name, stage in stages.items():
+        if name.startswith(DECODE_STAGE_PREFIX):
+            print('Decoded %s: %d slices, %.1f MB in %.2f s (%.1f MB/s per thread)'
+                  % (name[len(DECODE_STAGE_PREFIX):], stage['items'], stage['bytes'] / 1.0e6,
+                     stage['seconds'], stage['MBPerSecond']))
+
+
+#
+# Write a NRRD file ('<path>.nrrd', or '<path>.nhdr' and its data file when
+# 'detached' is True) with the encoding ('raw', 'gzip' or 'bzip2').
+# Returns a dictionary with the list of files written, the size of the data
+# ('rawBytes'), the size of the files ('fileBytes'), and the time spent.
+#
+def writeNrrd(path, data, header, encoding='raw', detached=False, compressionLevel=6):
+
+    header['encoding'] = encoding
+    if detached:
+        files = [path + '.nhdr', path + DATA_FILE_EXTENSIONS[encoding]]
+    else:
+        files = [path + '.nrrd']
+
+    start = time.time()
+    nrrd.write(files[0], data, header, detached_header=detached, compression_level=compressionLevel)
+    elapsed = time.time() - start
+    getInstrumentation().add('NRRD write', elapsed, 1, data.nbytes, start)
 
-    # Generate a list of slice positions
+    return {
+        'files'     : files,
+        'rawBytes'  : data.nbytes,
+        'fileBytes' : sum([os.path.getsize(f) for f in files]),
+        'writeTime' : elapsed,
+        }
+
+
+#
+# Decode the slices one at a time and append them to a NRRD file, so that only
+# one slice is in memory regardless of the number of slices.
+# ('sizes' defaults to (columns, rows, number of slices); for a 4D image, the
+# slices of all volumes are given in the order of the file.)
+# With nThreads > 1, the slices are decoded in batches of nThreads slices (see
+# decodeSlices()), so that only nThreads slices are in memory.
+# (Returns the same dictionary as writeNrrd().)
+#
+def streamNrrd(path, slices, header, dtype, encoding='raw', detached=False, compressionLevel=6, sizes=None,
+               decodeThreads=1):
+
+    columns = slices[0]['columns']
+    rows    = slices[0]['rows']
+    if sizes == None:
+        sizes = (columns, rows, len(slices))
+    writer = NrrdStreamWriter(path, header, dtype, sizes, encoding, detached, compressionLevel)
+    try:
+        batchSize = max(1, decodeThreads)
+        planes = np.empty((columns, rows, batchSize), dtype=dtype, order='F')
+        instrumentation = getInstrumentation()
+        for start in range(0, len(slices), batchSize):
+            batch = slices[start:start+batchSize]
+            decodeSlices(batch, lambda i: planes[:, :, i], decodeThreads)
+            for i in range(len(batch)):
+                with instrumentation.stage('NRRD write', nbytes=planes[:, :, i].nbytes):
+                    writer.write(planes[:, :, i])
+    except BaseException:
+        # Remove the partial file, and keep the original exception
+        writer.abort()
+        raise
+
+    return writer.close()
+
+
+#
+# Slice geometry of a series, computed at once for all slices.
+# 'positions' (slice, 3) are the ImagePositionPatient and 'orientations'
+# (slice, 6) the ImageOrientationPatient of the slices. The positions are
+# projected onto the slice normal and sorted. Returns a dictionary:
+#   'order'     : indices of the slices sorted along the normal
+#   'locations' : projected positions of the sorted slices
+#   'spacing'   : slice spacing (median distance between adjacent distinct
+#                 positions; None for a single slice)
+#   'issues'    : list of the problems found (different orientations,
+#                 duplicate positions, gaps, non-uniform spacing)
+#   'segments'  : indices of the sub-series (in the sorted order) obtained by
+#                 separating repeated positions and splitting at gaps
+#
+def sliceGeometry(positions, orientations, tolerance=1.0e-3):
+
+    positions = np.asarray(positions, dtype=float).reshape((-1, 3))
+    orientations = np.asarray(orientations, dtype=float).reshape((-1, 6))
+    nSlices = len(positions)
+
+    issues = []
+    if np.any(np.abs(orientations - orientations[0]) > tolerance):
+        issues.append('different orientations')
+    normal = np.cross(orientations[0, :3], orientations[0, 3:])
+    projected = positions @ normal
+    order = np.argsort(projected, kind='stable')
+    locations = projected[order]
+
+    geometry = {'order': order, 'locations': locations, 'spacing': None, 'issues': issues, 'segments': [order]}
+    if nSlices < 2:
+        return geometry
+
+    steps = np.diff(locations)
+    duplicate = steps <= tolerance
+    distinct = steps[~duplicate]
+    if len(distinct) == 0:
+        issues.append('all %d slices at the same position' % nSlices)
+        return geometry
+    spacing = float(np.median(distinct))
+    geometry['spacing'] = spacing
+
+    gap = steps > 1.5 * spacing
+    nonUniform = ~duplicate & ~gap & (np.abs(steps - spacing) > max(tolerance, 0.01 * spacing))
+    if duplicate.any():
+        issues.append('%d duplicate positions' % duplicate.sum())
+    if gap.any():
+        issues.append('%d gaps' % gap.sum())
+    if nonUniform.any():
+        issues.append('non-uniform spacing (%g-%g)' % (distinct.min(), distinct.max()))
+
+    # Separate the repeated positions: the k-th slice at each position (in
+    # the input order) goes to the k-th sub-series. Then split at the gaps.
+    index = np.arange(nSlices)
+    first = np.maximum.accumulate(np.where(np.append(True, ~duplicate), index, 0))
+    rank = index - first
+    segments = []
+    for r in range(rank.max() + 1):
+        segment = order[rank == r]
+        breaks = np.nonzero(np.diff(projected[segment]) > 1.5 * spacing)[0] + 1
+        segments = segments + np.split(segment, breaks)
+    geometry['segments'] = segments
+
+    return geometry
+
+
+#
+# Parse a multi-valued attribute recorded in the index (e.g. "[0.0, 0.0, 1.5]")
+# into 'n' floats. Returns None if the attribute is missing or malformed.
+#
+def parseIndexFloats(value, n):
+
+    try:
+        values = [float(x) for x in indexComponents(value)]
+    except (TypeError, ValueError):
+        return None
+    if len(values) != n:
+        return None
+    return values
+
+
+#
+# Geometry of a list of files from the index ('geometry' maps each path to its
+# (position, orientation) strings; see sliceGeometry()). Returns None if the
+# position or orientation of a file is not available.
+#
+def indexGeometry(filelist, geometry):
+
+    positions = [parseIndexFloats(geometry[path][0], 3) for path in filelist]
+    orientations = [parseIndexFloats(geometry[path][1], 6) for path in filelist]
+    if None in positions or None in orientations:
+        return None
+    return (np.array(positions), np.array(orientations))
+
+
+#
+# Check the geometry of a group of files from the index, before any pixel data
+# are decoded (the volumes of a 4D group are checked one by one).
+# policy: 'warn'  - report the problems and export the series as is
+#         'skip'  - do not export the series with problems
+#         'split' - export the sub-series with a uniform geometry (see
+#                   sliceGeometry()) as separate files ('<name>_1', '<name>_2', ...);
+#                   4D groups with problems are skipped
+# Returns the list of groups to be exported.
+#
+def checkGroupGeometry(group, geometry, policy='warn'):
+
+    if 'volumes' in group:
+        filelists = [(' (%s)' % value, filelist) for value, filelist in group['volumes']]
+    else:
+        filelists = [('', group['filelist'])]
+
+    problems = []
+    for name, filelist in filelists:
+        arrays = indexGeometry(filelist, geometry)
+        if arrays == None:
+            continue
+        result = sliceGeometry(*arrays)
+        if result['issues']:
+            problems.append((name, filelist, arrays, result))
+    if len(problems) == 0:
+        return [group]
+
+    for name, filelist, arrays, result in problems:
+        message = '%s%s: %s' % (group['filename'], name, ', '.join(result['issues']))
+        if policy == 'warn':
+            print('Warning: ' + message)
+        else:
+            print('Error: ' + message)
+    if policy == 'warn':
+        return [group]
+    if policy == 'skip' or 'volumes' in group:
+        print('Skipping %s' % group['filename'])
+        return []
+
+    name, filelist, (positions, orientations), result = problems[0]
+    groups = []
+    for i, segment in enumerate(result['segments']):
+        filename = '%s_%d' % (group['filename'], i + 1)
+        sub = sliceGeometry(positions[segment], orientations[segment])
+        if sub['issues']:
+            print('Error: %s: %s. Skipping.' % (filename, ', '.join(sub['issues'])))
+            continue
+        voxels = group['voxels'] * len(segment) // len(filelist)
+        groups.append({'filename': filename, 'filelist': [filelist[j] for j in segment], 'voxels': voxels})
+    print('Split %s into %d series' % (group['filename'], len(groups)))
+
+    return groups
+
+
+#
+# Read the slice headers of a series, sorted along the slice normal (see
+# sliceGeometry()). Returns a list of the slices, or None if the series cannot
+# be exported.
+#
+def readSeriesSlices(filelist):
+
+    # Generate a list of slice positions (from the headers only)
     slices = []
-    for i in range(nSlices):
+    for path in filelist:
         dataset = None
         try:
-            dataset = pydicom.dcmread(filelist[i], specific_tags=None)
+            dataset, nbytes = readDICOMHeader(path)
         except pydicom.errors.InvalidDicomError:
             print("Error: Invalid DICOM file: " + path)
             return None
@@ -150,48 +823,52 @@ def exportNrrd(filelist, dst=None, filename=None):
 
         try:
             sl = {
+                'path'           : path,
                 'position'       : np.array(dataset['00200032'].value), # ImagePositionPatient
                 'orientation'    : np.array(dataset['00200037'].value), # ImageOrientationPatient
                 'spacing'        : np.array(dataset['00280030'].value), # PixelSpacing
-                'sliceThickness' : dataset['00180050'].value, # SliceThickness
+                'sliceThickness' : getElementValue(dataset, '00180050'), # SliceThickness
                 'rows'           : dataset['00280010'].value, # Rows
                 'columns'        : dataset['00280011'].value, # Columns
-                'sliceLocation'  : dataset['00201041'].value, # SliceLocation
                 'bitsAllocated'  : dataset['00280100'].value, # BitsAllocated
-                'instanceNumber' : dataset['00200013'].value, # InstanceNumber -- image number
+                'bitsStored'     : getElementValue(dataset, '00280101', dataset['00280100'].value), # BitsStored
+                'pixelRepresentation' : dataset['00280103'].value, # PixelRepresentation
+                'instanceNumber' : getElementValue(dataset, '00200013'), # InstanceNumber -- image number
+                'seriesNumber'   : getElementValue(dataset, '00200011'), # SeriesNumber
+                'transferSyntax' : str(dataset.file_meta.get('TransferSyntaxUID', '')),
+                'rescaleIntercept' : rescaleIntercept,
+                'rescaleSlope'   : rescaleSlope,
                 }
         except KeyError:
             print('KeyError: Missing geometric information. Skipping.')
-            return
+            return None
         
-        if rescaleIntercept >= 0:
-            sl['pixelArray'] = dataset.pixel_array*rescaleSlope + rescaleIntercept
-        else:
-            sl['pixelArray'] = (dataset.pixel_array*rescaleSlope + rescaleIntercept).astype('int16')
-            
         slices.append(sl)
 
-    # Sort the slices
-    def keyfunc(e):
-        return e['sliceLocation']
+    # Sort the slices along the normal
+    geometry = sliceGeometry([sl['position'] for sl in slices], [sl['orientation'] for sl in slices])
+    slices = [slices[i] for i in geometry['order']]
 
-    slices.sort(key=keyfunc)
+    rows    = slices[0]['rows']
+    columns = slices[0]['columns']
+    for sl in slices:
+        if sl['rows'] != rows or sl['columns'] != columns:
+            print('Error: The slices have different matrix sizes. Skipping.')
+            return None
 
-    # Generate a 3D matrix
-    data = np.array([])
+    return slices
 
-    data = np.atleast_3d(np.transpose(slices[0]['pixelArray']))
-    for sl in slices[1:]:
-        data = np.append(data, np.atleast_3d(np.transpose(sl['pixelArray'])), axis=2)
-        
-    
-    #data = data.reshape((slices[0]['columns'], slices[0]['rows'], len(slices)))
-        
-    seriesNumber            = dataset['00200011'].value # (0020,0011) : SeriesNumber
 
-    sliceSpacing = sl['sliceThickness'] # for a single slice image
+#
+# NRRD header with the geometry of the sorted slices
+#
+def buildGeometryHeader(slices):
+
+    sliceSpacing = slices[-1]['sliceThickness'] or 1.0 # for a single slice image
     if len(slices) > 1:                 # for a multi-slice image
-        sliceSpacing = slices[1]['sliceLocation'] - slices[0]['sliceLocation']
+        geometry = sliceGeometry([sl['position'] for sl in slices], [sl['orientation'] for sl in slices])
+        if geometry['spacing']:
+            sliceSpacing = geometry['spacing']
         
     spacing = slices[0]['spacing']
     spacing = np.append(spacing, sliceSpacing)
@@ -203,74 +880,359 @@ def exportNrrd(filelist, dst=None, filename=None):
     header = {}
     header['space directions'] = np.transpose(norm * spacing)
     header['space origin'] = slices[0]['position']
-
-    nbytes = slices[0]['bitsAllocated'] / 8
-    nrrdType = ''
-    if nbytes == 1:
-        nrrdType = 'int8'
-    elif nbytes == 2:
-        nrrdType = 'short'
-    elif nbytes == 4:
-        nrrdType = 'int'
-
-    #header['type']      = nrrdType
-    #header['dimension'] = 3
     header['space']     = 'left-posterior-superior'
     header['kinds']      = ['domain', 'domain', 'domain']
-    header['encoding']  = 'raw'
 
-    seriesDescription       = dataset['0008103e'].value # (0008,103e) : SeriesDescription
-    patientsName            = dataset['00100010'].value # (0010,0010) : PatientsName
-    studyID                 = dataset['00200010'].value # (0020,0010) : StudyID
-    seriesNumber            = dataset['00200011'].value # (0020,0011) : SeriesNumber
-    imageOrientationPatient = dataset['00200037'].value # (0020,0037) : ImageOrientationPatient
-    acquisitionTime         = dataset['00080032'].value # (0008,0032) : AcquisitionTime
-    #print('%s: %s\t%s\t%s\t%d\n' % (seriesNumber, seriesDescription, imageOrientationPatient, acquisitionTime, nSlices))
-    #print('%s: %s\t%s\n' % (seriesNumber, pos[0], ori[0]))
+    return header
+
+
+#
+# Decode the slices (in the order of the file) into an image of 'sizes' and
+# write it (see writeNrrd() and streamNrrd()). If the rescaled values do not
+# fit in the integer type 'dtype', the image is written as float64 instead.
+#
+def writeSlices(path, slices, header, dtype, sizes, encoding='raw', detached=False, compressionLevel=6, stream=False,
+                decodeThreads=1):
+
+    try:
+        if stream:
+            return streamNrrd(path, slices, header, dtype, encoding, detached, compressionLevel, sizes, decodeThreads)
+
+        # Generate the matrix. The image is allocated once, and each slice is
+        # decoded into its plane. (Fortran order makes each plane contiguous.)
+        data = np.empty(sizes, dtype=dtype, order='F')
+        planes = data.reshape((sizes[0], sizes[1], -1), order='F')
+        decodeSlices(slices, lambda i: planes[:, :, i], decodeThreads)
+        return writeNrrd(path, data, header, encoding, detached, compressionLevel)
+
+    except PixelRangeError as e:
+        if np.dtype(dtype).kind == 'f':
+            raise
+        print('Warning: %s: %s. Writing float64 values.' % (os.path.basename(path), e))
+        header['type'] = NUMPY_TO_NRRD_TYPES['f8']
+        return writeSlices(path, slices, header, np.dtype('float64'), sizes, encoding, detached, compressionLevel,
+                           stream, decodeThreads)
+
+
+#
+# Export a list of DICOM files as a NRRD volume
+# With 'stream', the slices are decoded and written one at a time (see
+# streamNrrd()); otherwise the volume is assembled in memory.
+# (Returns the result of writeNrrd(), or None if the series is skipped.)
+#
+def exportNrrd(filelist, dst=None, filename=None, encoding='raw', detached=False, compressionLevel=6, stream=False,
+               decodeThreads=1, rescale='rescaled'):
+    # Obtain the image info from the first image
+
+    nSlices = len(filelist)
+
+    slices = readSeriesSlices(filelist)
+    if slices == None:
+        return None
+    rows    = slices[0]['rows']
+    columns = slices[0]['columns']
+
+    header = buildGeometryHeader(slices)
 
     if filename == None:
-        filename = 'output' + str(seriesNumber)
+        filename = 'output' + str(slices[0]['seriesNumber'])
+    path = filename
     if dst:
-        nrrd.write('%s/%s.nrrd' % (dst, filename), data, header)
-    else:
-        nrrd.write('%s.nrrd' % (filename), data, header)
+        path = '%s/%s' % (dst, filename)
+
+    dtype, slices = outputDataType(slices, header, rescale)
+    sizes = (columns, rows, nSlices)
+    return writeSlices(path, slices, header, dtype, sizes, encoding, detached, compressionLevel, stream, decodeThreads)
 
     
-def groupBySeriesAndExport(cur, tags, valueListDict, cond=None, filename=None, dst=None, prefix=None):
+#
+# Check that the volumes (lists of sorted slices) share the same geometry
+#
+def sameGeometry(volumes, tolerance=1.0e-3):
+
+    reference = volumes[0]
+    for slices in volumes[1:]:
+        if len(slices) != len(reference):
+            return False
+        for sl, ref in zip(slices, reference):
+            if sl['rows'] != ref['rows'] or sl['columns'] != ref['columns']:
+                return False
+            for key in ['position', 'orientation', 'spacing']:
+                if sl[key].shape != ref[key].shape or not np.allclose(sl[key], ref[key], atol=tolerance):
+                    return False
+
+    return True
 
-    if len(tags) == 0:
-        cur.execute('SELECT path FROM dicom WHERE ' + cond)
-        paths = cur.fetchall()
-        if len(paths) == 0:
-            return
+
+#
+# Export volumes that differ only in the value of 'tag' as a single 4D NRRD
+# file. The volumes are stacked along a 4th axis of the 'list' kind, and the
+# values of the tag are recorded in the key/value fields (Slicer MultiVolume
+# convention):
+#   MultiVolume.FrameIdentifyingDICOMTagName : keyword of the tag
+#   MultiVolume.FrameLabels                  : comma-separated values
+#   MultiVolume.NumberOfFrames               : number of volumes
+# 'volumes' is a list of (value, filelist), in the order of the 4th axis.
+# (Returns the result of writeNrrd(), or None if the series is skipped.)
+#
+def exportNrrd4D(volumes, tag, dst=None, filename=None, encoding='raw', detached=False, compressionLevel=6, stream=False,
+                 decodeThreads=1, rescale='rescaled'):
+
+    series = []
+    for value, filelist in volumes:
+        slices = readSeriesSlices(filelist)
+        if slices == None:
+            return None
+        series.append(slices)
+
+    # The geometry is validated once for all volumes
+    if not sameGeometry(series):
+        print('Error: The volumes of %s have different geometries. Skipping.' % filename)
+        return None
+
+    slices = series[0]
+    rows    = slices[0]['rows']
+    columns = slices[0]['columns']
+    sizes = (columns, rows, len(slices), len(series))
+
+    header = buildGeometryHeader(slices)
+    header['space directions'] = np.append(header['space directions'], np.full((1, 3), np.nan), axis=0)
+    header['kinds'] = header['kinds'] + ['list']
+    keyword = pydicom.datadict.keyword_for_tag(int(tag.replace(',', ''), 16))
+    header['MultiVolume.FrameIdentifyingDICOMTagName'] = keyword or tag
+    header['MultiVolume.FrameLabels'] = ','.join([str(value) for value, filelist in volumes])
+    header['MultiVolume.NumberOfFrames'] = str(len(volumes))
+
+    if filename == None:
+        filename = 'output' + str(slices[0]['seriesNumber'])
+    path = filename
+    if dst:
+        path = '%s/%s' % (dst, filename)
+
+    allSlices = [sl for slices in series for sl in slices]
+    dtype, allSlices = outputDataType(allSlices, header, rescale)
+    return writeSlices(path, allSlices, header, dtype, sizes, encoding, detached, compressionLevel, stream, decodeThreads)
+
+
+#
+# List the groups of files (series) to be exported. Each group is a
+# dictionary with the output file name, the list of files and the
+# estimated number of voxels. The groups are obtained from a single query
+# ordered by the tag values, so only the non-empty groups are generated.
+# With 'collapseTag', the files that differ only in the value of that tag
+# form one group, with the list of (value, filelist) of its volumes in
+# 'volumes' (sorted by the value; numerically if possible), to be exported
+# as a 4D image.
+# The slice geometry of each group is checked with checkGroupGeometry()
+# according to 'geometryPolicy'. The hash of the input files of each group
+# (see run_journal.py) is in 'inputHash'.
+#
+def listSeriesGroups(cur, tags, collapseTag=None, geometryPolicy='warn'):
+
+    colNames = [tagColumnName(tag) for tag in tags]
+    if collapseTag:
+        colNames.append(tagColumnName(collapseTag))
+    nTags = len(tags)
+    nCols = len(colNames)
+    cur.execute('SELECT ' + ','.join(colNames) + ',path,'
+                + tagColumnName('00280010') + ',' + tagColumnName('00280011') + ','
+                + tagColumnName('00200032') + ',' + tagColumnName('00200037') + ',mtime,size'
+                + ' FROM dicom ORDER BY ' + ','.join(colNames) + ',path')
+
+    groups = []
+    for values, rows in itertools.groupby(cur, key=lambda r: r[:nTags]):
         filelist = []
-        for p in paths:
-            filelist.append(str(p[0]))
+        volumes = {}
+        geometry = {}
+        fileStats = {}
+        nVoxels = 0
+        for row in rows:
+            path, nRows, nColumns, position, orientation, mtime, size = row[nCols:]
+            filelist.append(str(path))
+            geometry[str(path)] = (position, orientation)
+            fileStats[str(path)] = (mtime, size)
+            if collapseTag:
+                volumes.setdefault(row[nTags], []).append(str(path))
+            if nRows and nColumns:
+                nVoxels = nVoxels + int(nRows) * int(nColumns)
+        filename = '-'.join([value.replace('/', '.') for value in values])
+        group = {'filename': filename, 'filelist': filelist, 'voxels': nVoxels}
+        if collapseTag:
+            def keyfunc(value):
+                try:
+                    return (0, float(value), value)
+                except ValueError:
+                    return (1, 0.0, value)
+            group['tag'] = collapseTag
+            group['volumes'] = [(value, volumes[value]) for value in sorted(volumes, key=keyfunc)]
+        for checked in checkGroupGeometry(group, geometry, geometryPolicy):
+            extra = None
+            if 'volumes' in checked:
+                extra = [checked['tag']] + [value for value, filelist in checked['volumes']]
+            checked['inputHash'] = inputHash(checked['filelist'], fileStats, extra)
+            groups.append(checked)
+
+    return groups
+
+
+# Prefix of the temporary directories in the destination directory
+TEMP_DIR_PREFIX = '.dicom_to_nrrd-tmp-'
+
+#
+# Export a group of files (Called in a worker process.)
+# 'options' are passed to exportNrrd() as keyword arguments. A series larger
+# than options['streamVoxels'] voxels is streamed (see streamNrrd()).
+# The files are written in a temporary directory in 'dst' and then renamed
+# into 'dst' (the data file first), so that a file in 'dst' is always complete.
+# Returns the group, the time spent in seconds, the result of exportNrrd() and
+# the instrumentation data.
+#
+def exportSeriesGroup(group, dst, options={}):
+
+    start = time.time()
+    options = dict(options)
+    streamVoxels = options.pop('streamVoxels', None)
+    if streamVoxels and group['voxels'] > streamVoxels:
+        options['stream'] = True
+    tempDir = tempfile.mkdtemp(prefix=TEMP_DIR_PREFIX, dir=dst)
+    try:
+        with collectInstrumentation() as instrumentation:
+            instrumentation.log('Writing ' + dst + '/' + group['filename'])
+            if 'volumes' in group:
+                written = exportNrrd4D(group['volumes'], group['tag'], tempDir, group['filename'], **options)
+            else:
+                written = exportNrrd(group['filelist'], tempDir, group['filename'], **options)
+        if written:
+            files = []
+            for file in reversed(written['files']):
+                files.insert(0, os.path.join(dst, os.path.basename(file)))
+                os.replace(file, files[0])
+            written['files'] = files
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
+
+    return (group, time.time() - start, written, instrumentation.data())
 
-        print('Writing ' + dst + '/' + filename)
-        exportNrrd(filelist, dst, filename)
 
+def reportSeriesExport(group, elapsed, written, data=None):
+
+    instrumentation = getInstrumentation()
+    instrumentation.merge(data)
+    instrumentation.advance()
+    if not written:
+        instrumentation.log('Not exported: %s' % group['filename'])
         return
 
-    # Note: We add prefix 'x' to the DICOM tag as the DICOM tags are recognized as intenger
-    #       by SQLight
-    tag = 'x' + tags[0].replace(',', '')
-    values = list(valueListDict[tag])
-    tags2 = tags[1:]
-    
-    for tp in values:
-        value = tp[0]
-        cond2 = ''
-        filename2 = ''
-        if cond==None:
-            cond2 = tag + ' == ' + "'" + value + "'"
-        else:
-            cond2 = cond + ' AND ' + tag + ' == ' + "'" + value + "'"
-        if filename==None:
-            filename2 = value.replace('/', '.')
-        else:
-            filename2 = filename + '-' + value.replace('/', '.')
-        groupBySeriesAndExport(cur, tags2, valueListDict, cond2, filename2, dst=dst)
+    rate = 0.0
+    if elapsed > 0:
+        rate = group['voxels'] / elapsed / 1.0e6
+    message = ('Exported %s: %d slices, %.2f s (%.1f Mvoxels/s)'
+               % (group['filename'], len(group['filelist']), elapsed, rate))
+    ratio = 0.0
+    if written['fileBytes'] > 0:
+        ratio = written['rawBytes'] / written['fileBytes']
+    throughput = 0.0
+    if written['writeTime'] > 0:
+        throughput = written['rawBytes'] / written['writeTime'] / 1.0e6
+    message = message + ('; %.1f MB written (compression ratio %.2f, %.1f MB/s)'
+                         % (written['fileBytes'] / 1.0e6, ratio, throughput))
+    instrumentation.log(message)
+
+
+#
+# Export the groups of files. With nJobs > 1, the series are exported in a pool
+# of nJobs processes. A series is only started when the total estimated number
+# of voxels of the series in progress stays within maxVoxels (at least one
+# series is always in progress).
+# With 'journal' (see run_journal.py), each series is recorded in the journal
+# as soon as it is written, with 'settings'.
+#
+def exportSeriesGroups(groups, dst, nJobs=1, maxVoxels=None, options={}, journal=None, settings=''):
+
+    start = time.time()
+    getInstrumentation().startProgress('Series', len(groups))
+    nWritten = 0
+
+    def finished(group, elapsed, written, data):
+        nonlocal nWritten
+        reportSeriesExport(group, elapsed, written, data)
+        if written:
+            nWritten = nWritten + 1
+        if journal and written:
+            journal.record(group['filename'], group['inputHash'], settings, written['files'])
+
+    if nJobs <= 1:
+        for group in groups:
+            finished(*exportSeriesGroup(group, dst, options))
+    else:
+        pending = list(groups)
+        running = set()
+        runningVoxels = 0
+        with concurrent.futures.ProcessPoolExecutor(nJobs) as executor:
+            while pending or running:
+                while pending and len(running) < nJobs:
+                    voxels = pending[0]['voxels']
+                    if running and maxVoxels and runningVoxels + voxels > maxVoxels:
+                        break
+                    group = pending.pop(0)
+                    running.add(executor.submit(exportSeriesGroup, group, dst, options))
+                    runningVoxels = runningVoxels + voxels
+                done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    runningVoxels = runningVoxels - result[0]['voxels']
+                    finished(*result)
+
+    getInstrumentation().finishProgress()
+    print('Exported %d series in %.2f s' % (nWritten, time.time() - start))
+    if nWritten < len(groups):
+        print('Skipped %d series' % (len(groups) - nWritten))
+    reportDecodeThroughput()
+
+
+#
+# Settings of the export that affect the output files (recorded in the journal)
+#
+def exportSettings(options):
+
+    settings = {k: v for k, v in options.items() if not (k in ['stream', 'streamVoxels', 'decodeThreads'])}
+    return json.dumps(settings, sort_keys=True)
+
+
+#
+# Group the files into series and export them. The temporary directories left
+# in 'dst' by an interrupted run are removed. With 'resume', the series are
+# recorded in the run journal in 'dst' (see run_journal.py), and the series
+# whose outputs are complete and up to date are skipped.
+#
+def groupBySeriesAndExport(cur, tags, dst=None, nJobs=1, maxVoxels=None, options={}, collapseTag=None,
+                           geometryPolicy='warn', resume=False):
+
+    groups = listSeriesGroups(cur, tags, collapseTag, geometryPolicy)
+
+    # Remove the temporary directories of an interrupted run
+    for name in os.listdir(dst):
+        if name.startswith(TEMP_DIR_PREFIX):
+            shutil.rmtree(os.path.join(dst, name), ignore_errors=True)
+
+    journal = None
+    settings = exportSettings(options)
+    if resume:
+        journal = RunJournal(dst)
+        pending = []
+        for group in groups:
+            if journal.isComplete(group['filename'], group['inputHash'], settings):
+                getInstrumentation().log('Up to date: ' + dst + '/' + group['filename'])
+            else:
+                pending.append(group)
+        print('Resume: %d series up to date, %d to be exported' % (len(groups) - len(pending), len(pending)))
+        groups = pending
+
+    try:
+        exportSeriesGroups(groups, dst, nJobs, maxVoxels, options, journal, settings)
+    finally:
+        if journal:
+            journal.close()
 
 
 def main(argv):
@@ -286,30 +1248,113 @@ def main(argv):
         parser.add_argument('-r', dest='recursive', action='store_const',
                             const=True, default=False,
                             help='search the source directory recursively')
+        parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                            help='number of processes to parse the DICOM headers and export the series (0: number of CPUs)')
+        parser.add_argument('--max-voxels', dest='maxVoxels', type=float, default=2.5e8,
+                            help='maximum total number of voxels of the series exported at the same time (default: 2.5e8)')
+        parser.add_argument('-e', '--encoding', dest='encoding', type=str, default='raw',
+                            choices=['raw', 'gzip', 'bzip2'],
+                            help='encoding of the NRRD files (default: raw)')
+        parser.add_argument('--compression-level', dest='compressionLevel', type=int, default=6,
+                            choices=range(1, 10), metavar='{1-9}',
+                            help='compression level for gzip/bzip2 (1-9, default: 6)')
+        parser.add_argument('--detached', dest='detached', action='store_const',
+                            const=True, default=False,
+                            help='write detached headers (.nhdr) and data files (.raw, .raw.gz or .raw.bz2)')
+        parser.add_argument('-f', '--filter', dest='filter', type=str, default=None, metavar='EXPR',
+                            help='only export the files that satisfy the filter expression '
+                            '(e.g. "InversionTime in 100..1000 and 00511016 == R/DIS2D"; see tag_filter.py)')
+        parser.add_argument('--include', dest='include', action='append', default=None, metavar='PATTERN',
+                            help='only process the files whose names match the pattern (e.g. "*.dcm"; can be repeated)')
+        parser.add_argument('--exclude', dest='exclude', action='append', default=None, metavar='PATTERN',
+                            help='skip the files whose names match the pattern (can be repeated; hidden files and DICOMDIR are always skipped)')
+        parser.add_argument('--decode-threads', dest='decodeThreads', type=int, default=0,
+                            help='number of threads to decode the slices in compressed transfer syntaxes (JPEG, JPEG-LS, '
+                            'JPEG 2000, RLE) in each series (default: 0, the number of CPUs divided by -j)')
+        parser.add_argument('--rescale', dest='rescale', type=str, default='rescaled', choices=RESCALE_MODES,
+                            help='output values: rescaled (default; U = m*SV + b, as floating point values unless m and b are '
+                            'integer types), exact (rescaled, in the narrowest integer type that holds all possible values '
+                            'exactly, or float64 for non-integer m or b), or stored (stored values in their own type, with m and b recorded in the header)')
+        parser.add_argument('--stream', dest='stream', action='store_const',
+                            const=True, default=False,
+                            help='decode and write one slice at a time, so that only one slice is kept in memory '
+                            '(series larger than --max-voxels are always streamed)')
+        parser.add_argument('--4d', dest='collapseTag', type=str, default=None, metavar='TAG',
+                            help='export the series that differ only in the value of TAG (e.g. 00180082) as one 4D NRRD file, '
+                            'with the volumes along the 4th axis and the values of TAG in the header')
+        parser.add_argument('--geometry', dest='geometry', type=str, default='warn',
+                            choices=['warn', 'skip', 'split'],
+                            help='what to do with series with duplicate slice positions, gaps, non-uniform spacing or '
+                            'different orientations: report and export them as they are (warn; default), skip them, '
+                            'or split them into series with a uniform geometry (split)')
+        parser.add_argument('--resume', dest='resume', action='store_const',
+                            const=True, default=False,
+                            help='record the series written in a run journal in DST_DIR, and skip the series whose '
+                            'outputs are complete and up to date (e.g. to resume an interrupted run)')
+        parser.add_argument('--index', dest='index', type=str, default=None,
+                            help='file index database to be reused across runs (only new or modified files are parsed)')
+        parser.add_argument('-q', '--quiet', dest='quiet', action='store_const',
+                            const=True, default=False,
+                            help='do not list the series; show a progress bar instead')
+        parser.add_argument('--profile', dest='profile', type=str, default=None, metavar='FILE',
+                            help='report the time spent in each stage, and write the profile and trace to a JSON file')
         args = parser.parse_args(argv)
 
     except Exception as e:
         print(e)
 
+    configureInstrumentation(args.quiet, args.profile)
     tags   = args.tags
+    collapseTag = args.collapseTag
+    if collapseTag:
+        collapseTag = collapseTag.replace(',', '').upper()
+        tags = [tag for tag in tags if tag.replace(',', '').upper() != collapseTag]
+        if len(tags) == 0:
+            sys.exit('ERROR: At least one tag other than the --4d tag is needed to name the files.')
     srcdir = args.src[0]
     dstdir = args.dst[0]
+    nJobs  = args.jobs
+    if nJobs <= 0:
+        nJobs = os.cpu_count()
+    decodeThreads = args.decodeThreads
+    if decodeThreads <= 0:
+        decodeThreads = max(1, os.cpu_count() // nJobs)
 
-    con = sqlite3.connect(':memory:')
-    #con = sqlite3.connect('TestDB.db')
+    if args.index:
+        con = sqlite3.connect(args.index)
+    else:
+        con = sqlite3.connect(':memory:')
     cur = con.cursor()
     
-    buildFilePathDBByTags(con, srcdir, tags, True)
-     
-    # Generate a list of values for each tag
-    valueListDict = {}
-    for tag in tags:
-        colName = 'x' + tag.replace(',', '')
-        cur.execute('SELECT ' + colName + ' FROM dicom GROUP BY ' + colName)
-        valueListDict[colName] = cur.fetchall()
+    tagFilter = None
+    indexTags = tags
+    if collapseTag:
+        indexTags = indexTags + [collapseTag]
+    if args.filter:
+        try:
+            tagFilter = compileFilter(args.filter)
+        except ValueError as e:
+            sys.exit('ERROR: %s' % e)
+        indexTags = indexTags + ['%08X' % t for t in sorted(tagFilter.tags)]
+
+    fileFilter = DICOMFileFilter(args.include, args.exclude)
+    buildFilePathDBByTags(con, srcdir, indexTags, True, nJobs, fileFilter)
+    if tagFilter:
+        selectFilesByFilter(con, tagFilter)
 
     os.makedirs(dstdir, exist_ok=True)        
-    groupBySeriesAndExport(cur, tags, valueListDict, cond=None, filename=None, dst=dstdir)
+    options = {
+        'encoding'         : args.encoding,
+        'detached'         : args.detached,
+        'compressionLevel' : args.compressionLevel,
+        'stream'           : args.stream,
+        'streamVoxels'     : args.maxVoxels,
+        'decodeThreads'    : decodeThreads,
+        'rescale'          : args.rescale,
+        }
+    groupBySeriesAndExport(cur, tags, dst=dstdir, nJobs=nJobs, maxVoxels=args.maxVoxels, options=options,
+                           collapseTag=collapseTag, geometryPolicy=args.geometry, resume=args.resume)
+    finishInstrumentation(args.profile)
 
     sys.exit()
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+
+from instrumentation import getInstrumentation
+
+
+#  Placement of the matched/extracted files for dicom_list_by_tag.py and
+#  dicom_separate_by_tag.py
+#
+#  Modes:
+#   - 'copy'     : copy the file
+#   - 'move'     : move the file
+#   - 'hardlink' : create a hard link (same file system only)
+#   - 'reflink'  : create a copy-on-write clone (e.g. Btrfs, XFS; Linux only)
+#   - 'symlink'  : create a symbolic link to the absolute path of the file
+#   - 'manifest' : do not touch the files; only record "SOURCE<TAB>DESTINATION"
+#                  in a manifest file
+#  Except for 'copy', no data are duplicated.
+#  The time spent in placing the files is accounted to the 'transfer' stage
+#  (see instrumentation.py).
+
+TRANSFER_MODES = ['copy', 'move', 'hardlink', 'reflink', 'symlink', 'manifest']
+
+TRANSFER_VERBS = {
+    'copy'     : 'Copying',
+    'move'     : 'Moving',
+    'hardlink' : 'Linking',
+    'reflink'  : 'Cloning',
+    'symlink'  : 'Linking',
+    'manifest' : 'Listing',
+    }
+
+# FICLONE ioctl request (linux/fs.h)
+FICLONE = 0x40049409
+
+
+#
+# Clone a file with a copy-on-write reflink (Linux)
+#
+def reflinkFile(src, dst):
+
+    import fcntl
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError as e:
+                fdst.close()
+                os.remove(dst)
+                raise OSError(e.errno, 'reflink is not supported for %s -> %s (%s)' % (src, dst, e.strerror))
+    shutil.copystat(src, dst)
+
+
+class FileTransfer:
+
+    def __init__(self, mode='copy', manifestPath=None):
+
+        if not (mode in TRANSFER_MODES):
+            raise ValueError('Unknown transfer mode: %s' % mode)
+        self.mode = mode
+        self.verb = TRANSFER_VERBS[mode]
+        self.reserved = set()
+        self.manifest = None
+        if mode == 'manifest':
+            self.manifest = open(manifestPath, 'w')
+
+    #
+    # Check if the destination path is taken, either by an existing file or by a
+    # file already placed (or listed) by this object
+    #
+    def exists(self, path):
+
+        return path in self.reserved or os.path.lexists(path)
+
+    #
+    # Reserve the destination path for a file to be placed later
+    #
+    def reserve(self, path):
+
+        self.reserved.add(path)
+
+    #
+    # Place 'src' at 'dst'
+    #
+    def transfer(self, src, dst):
+
+        self.reserved.add(dst)
+        with getInstrumentation().stage('transfer'):
+            if self.mode == 'copy':
+                shutil.copy(src, dst)
+            elif self.mode == 'move':
+                shutil.move(src, dst)
+            elif self.mode == 'hardlink':
+                os.link(src, dst)
+            elif self.mode == 'reflink':
+                reflinkFile(src, dst)
+            elif self.mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            elif self.mode == 'manifest':
+                self.manifest.write('%s\t%s\n' % (src, dst))
+
+    def close(self):
+
+        if self.manifest:
+            self.manifest.close()
+            self.manifest = None
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import json
+import threading
+import contextlib
+
+
+#  Stage timers, counters and progress output for the DICOM/NRRD tools
+#
+#  The time spent in each stage of a tool (e.g. walking the directories,
+#  parsing the headers, decoding the pixel data, writing the NRRD files) is
+#  accumulated together with the number of items and bytes processed, so that
+#  the stage limiting a given dataset can be identified. The tools use the
+#  current instance (getInstrumentation()), configured from the command line:
+#    - quiet   : the per-file messages (log()) are suppressed, and a progress
+#                bar (throttled) is shown on stderr instead
+#    - profile : the stage summary is printed at the end and written to a JSON
+#                file, together with the trace of the stages in the Chrome trace
+#                event format ("traceEvents"; chrome://tracing or Perfetto)
+#
+#  Work done in a worker process (or in a pool task run inline) is measured
+#  in its own instance (collectInstrumentation()), whose data() is returned
+#  with the result and merged in the main process.
+
+
+# Standard stages (other names can be used)
+STAGES = ['walk', 'header parse', 'DB insert', 'transfer', 'pixel decode', 'assembly', 'NRRD write',
+          'image read', 'label stats']
+
+# Maximum number of trace events recorded
+MAX_TRACE_EVENTS = 200000
+
+# Minimum interval between updates of the progress bar (seconds)
+PROGRESS_INTERVAL = 0.2
+
+
+class Instrumentation:
+
+    def __init__(self, quiet=False, profile=False):
+
+        self.quiet = quiet
+        self.profile = profile
+        self.startTime = time.time()
+        self.stages = {}     # name: [seconds, calls, items, bytes]
+        self.counters = {}
+        self.events = []
+        self.nDropped = 0
+        self.lock = threading.Lock()
+        self.progressLabel = None
+        self.progressTotal = None
+        self.progressDone = 0
+        self.progressStart = 0.0
+        self.progressTime = 0.0
+
+    #
+    # Add the time spent in a stage ('start' is the start time, for the trace)
+    #
+    def add(self, name, seconds, items=1, nbytes=0, start=None):
+
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0, 0, 0])
+            stage[0] += seconds
+            stage[1] += 1
+            stage[2] += items
+            stage[3] += nbytes
+            if self.profile and start != None:
+                if len(self.events) < MAX_TRACE_EVENTS:
+                    self.events.append((name, start, seconds, os.getpid(), threading.get_ident()))
+                else:
+                    self.nDropped += 1
+
+    #
+    # Time a block of code as a stage:
+    #   with getInstrumentation().stage('NRRD write', nbytes=data.nbytes):
+    #       ...
+    #
+    @contextlib.contextmanager
+    def stage(self, name, items=1, nbytes=0):
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start, items, nbytes, start)
+
+    #
+    # Iterate over 'iterable', accounting the time spent in generating each item
+    # to the stage (e.g. walking the directories)
+    #
+    def iterate(self, name, iterable):
+
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.time() - start, 0, 0, None)
+                return
+            self.add(name, time.time() - start, 1, 0, None)
+            yield item
+
+    def count(self, name, n=1):
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    #
+    # Print a per-item message (suppressed in the quiet mode)
+    #
+    def log(self, message):
+
+        if not self.quiet:
+            print(message)
+
+    #
+    # Progress bar (shown in the quiet mode only). 'total' may be None if unknown.
+    #
+    def startProgress(self, label, total=None):
+
+        self.finishProgress()
+        self.progressLabel = label
+        self.progressTotal = total
+        self.progressDone = 0
+        self.progressStart = time.time()
+        self.progressTime = self.progressStart
+
+    def advance(self, n=1):
+
+        with self.lock:
+            self.progressDone += n
+            now = time.time()
+            if not self.quiet or self.progressLabel == None or now - self.progressTime < PROGRESS_INTERVAL:
+                return
+            self.progressTime = now
+            self.drawProgress(now)
+
+    def drawProgress(self, now):
+
+        rate = 0.0
+        if now > self.progressStart:
+            rate = self.progressDone / (now - self.progressStart)
+        if self.progressTotal:
+            fraction = min(1.0, self.progressDone / self.progressTotal)
+            bar = '#' * int(fraction * 30)
+            text = '\r%s [%-30s] %d/%d (%.1f/s)' % (self.progressLabel, bar, self.progressDone, self.progressTotal, rate)
+        else:
+            text = '\r%s %d (%.1f/s)' % (self.progressLabel, self.progressDone, rate)
+        sys.stderr.write(text)
+        sys.stderr.flush()
+
+    def finishProgress(self):
+
+        if self.quiet and self.progressLabel != None and self.progressDone > 0:
+            self.drawProgress(time.time())
+            sys.stderr.write('\n')
+            sys.stderr.flush()
+        self.progressLabel = None
+
+    #
+    # Measurements as a dictionary (to be returned from a worker process)
+    #
+    def data(self):
+
+        with self.lock:
+            return {
+                'stages'   : {name: list(stage) for name, stage in self.stages.items()},
+                'counters' : dict(self.counters),
+                'events'   : list(self.events),
+                'dropped'  : self.nDropped,
+                }
+
+    #
+    # Merge the measurements of a worker (data())
+    #
+    def merge(self, data):
+
+        if data == None:
+            return
+        with self.lock:
+            for name, values in data['stages'].items():
+                stage = self.stages.setdefault(name, [0.0, 0, 0, 0])
+                for i in range(4):
+                    stage[i] += values[i]
+            for name, n in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            room = MAX_TRACE_EVENTS - len(self.events)
+            self.events.extend(data['events'][:room])
+            self.nDropped += data['dropped'] + max(0, len(data['events']) - room)
+
+    #
+    # Summary of the stages (in the order of STAGES, then the others)
+    #
+    def summary(self):
+
+        wallTime = time.time() - self.startTime
+        names = [n for n in STAGES if n in self.stages] + sorted([n for n in self.stages if not (n in STAGES)])
+        stages = {}
+        for name in names:
+            seconds, calls, items, nbytes = self.stages[name]
+            rate = 0.0
+            throughput = 0.0
+            if seconds > 0:
+                rate = items / seconds
+                throughput = nbytes / seconds / 1.0e6
+            stages[name] = {
+                'seconds'        : seconds,
+                'calls'          : calls,
+                'items'          : items,
+                'bytes'          : nbytes,
+                'itemsPerSecond' : rate,
+                'MBPerSecond'    : throughput,
+                }
+        return {'wallTime' : wallTime, 'stages' : stages, 'counters' : dict(self.counters)}
+
+    #
+    # Print the stage summary. (The times of the stages run in parallel are
+    # summed, and may exceed the wall time.)
+    #
+    def report(self):
+
+        summary = self.summary()
+        print('Stage profile (wall time %.2f s):' % summary['wallTime'])
+        for name, stage in summary['stages'].items():
+            line = '  %-14s %9.3f s %8d items %10.1f items/s' % (name, stage['seconds'], stage['items'], stage['itemsPerSecond'])
+            if stage['bytes'] > 0:
+                line = line + ' %8.1f MB/s' % stage['MBPerSecond']
+            print(line)
+        for name, n in sorted(summary['counters'].items()):
+            print('  %-14s %d' % (name, n))
+
+    #
+    # Write the summary and the trace events to a JSON file
+    #
+    def writeProfile(self, path):
+
+        summary = self.summary()
+        summary['droppedTraceEvents'] = self.nDropped
+        summary['traceEvents'] = [{'name' : name, 'cat' : 'stage', 'ph' : 'X',
+                                   'ts' : (start - self.startTime) * 1.0e6, 'dur' : seconds * 1.0e6,
+                                   'pid' : pid, 'tid' : tid}
+                                  for name, start, seconds, pid, tid in self.events]
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=1)
+
+
+# Current instance
+current = Instrumentation()
+
+
+def getInstrumentation():
+
+    return current
+
+
+#
+# Configure the instrumentation from the command line options ('quiet' and
+# the path of the profile, or None)
+#
+def configureInstrumentation(quiet=False, profile=None):
+
+    global current
+    current = Instrumentation(quiet, profile != None)
+    return current
+
+
+#
+# Measure the work in a block in a separate instance, e.g. in a worker
+# process. The data() of the instance are to be merged in the main process:
+#   with collectInstrumentation() as instrumentation:
+#       ...
+#   return (result, instrumentation.data())
+#
+@contextlib.contextmanager
+def collectInstrumentation():
+
+    global current
+    parent = current
+    current = Instrumentation(parent.quiet, parent.profile)
+    current.startTime = parent.startTime
+    try:
+        yield current
+    finally:
+        current = parent
+
+
+#
+# Print the summary and write the profile at the end of a tool ('profile' is
+# the path of the profile, or None)
+#
+def finishInstrumentation(profile=None):
+
+    current.finishProgress()
+    if profile:
+        current.report()
+        current.writeProfile(profile)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import os
+
+import numpy
+
+
+#  Memory-mapped access to raw-encoded NRRD files
+#
+#  dicom_to_nrrd.py writes NRRD files with the raw encoding. For these files,
+#  the data section can be mapped into memory instead of being read, so that
+#  only the pages that are actually accessed (e.g. the slabs that contain ROIs)
+#  are read from the disk, and the data keep their native type.
+
+
+# NRRD type names and NumPy data types
+NRRD_TYPES = {
+    'signed char'            : 'i1',
+    'int8'                   : 'i1',
+    'int8_t'                 : 'i1',
+    'uchar'                  : 'u1',
+    'unsigned char'          : 'u1',
+    'uint8'                  : 'u1',
+    'uint8_t'                : 'u1',
+    'short'                  : 'i2',
+    'short int'              : 'i2',
+    'signed short'           : 'i2',
+    'signed short int'       : 'i2',
+    'int16'                  : 'i2',
+    'int16_t'                : 'i2',
+    'ushort'                 : 'u2',
+    'unsigned short'         : 'u2',
+    'unsigned short int'     : 'u2',
+    'uint16'                 : 'u2',
+    'uint16_t'               : 'u2',
+    'int'                    : 'i4',
+    'signed int'             : 'i4',
+    'int32'                  : 'i4',
+    'int32_t'                : 'i4',
+    'uint'                   : 'u4',
+    'unsigned int'           : 'u4',
+    'uint32'                 : 'u4',
+    'uint32_t'               : 'u4',
+    'longlong'               : 'i8',
+    'long long'              : 'i8',
+    'long long int'          : 'i8',
+    'signed long long'       : 'i8',
+    'signed long long int'   : 'i8',
+    'int64'                  : 'i8',
+    'int64_t'                : 'i8',
+    'ulonglong'              : 'u8',
+    'unsigned long long'     : 'u8',
+    'unsigned long long int' : 'u8',
+    'uint64'                 : 'u8',
+    'uint64_t'               : 'u8',
+    'float'                  : 'f4',
+    'double'                 : 'f8',
+    }
+
+
+#
+# Read the header of a NRRD file (.nrrd or detached .nhdr)
+# Returns a tuple (fields, keyValues, dataFile, dataOffset):
+#   fields     : dictionary of the header fields (as strings; field names in lower case)
+#   keyValues  : dictionary of the key/value pairs ("key:=value")
+#   dataFile   : path of the file that contains the data
+#   dataOffset : offset of the data in 'dataFile', in bytes
+#
+def readNrrdHeader(path):
+
+    fields = {}
+    keyValues = {}
+    with open(path, 'rb') as f:
+        magic = f.readline()
+        if not magic.startswith(b'NRRD'):
+            raise ValueError('Not a NRRD file: %s' % path)
+        while True:
+            line = f.readline()
+            if line == b'' or line.strip() == b'':
+                break
+            line = line.decode('ascii', errors='replace').rstrip('\r\n')
+            if line.startswith('#'):
+                continue
+            if ':=' in line:
+                key, value = line.split(':=', 1)
+                keyValues[key] = value
+            elif ': ' in line:
+                key, value = line.split(': ', 1)
+                fields[key.strip().lower()] = value.strip()
+        headerSize = f.tell()
+
+    dataFile = path
+    dataOffset = headerSize
+    if 'data file' in fields or 'datafile' in fields:
+        name = fields.get('data file', fields.get('datafile'))
+        if name.startswith('LIST') or len(name.split()) > 1:
+            raise ValueError('Multiple data files are not supported: %s' % path)
+        dataFile = os.path.join(os.path.dirname(path), name)
+        dataOffset = 0
+
+    # Skip lines/bytes at the beginning of the data
+    lineSkip = int(fields.get('line skip', fields.get('lineskip', '0')))
+    if lineSkip > 0:
+        with open(dataFile, 'rb') as f:
+            f.seek(dataOffset)
+            for i in range(lineSkip):
+                f.readline()
+            dataOffset = f.tell()
+    byteSkip = int(fields.get('byte skip', fields.get('byteskip', '0')))
+    if byteSkip > 0:
+        dataOffset = dataOffset + byteSkip
+    elif byteSkip == -1:
+        dataOffset = None  # The data are at the end of the file (see openNrrdMemmap())
+
+    return (fields, keyValues, dataFile, dataOffset)
+
+
+#
+# Check if a NRRD file can be memory-mapped (i.e. raw encoding)
+#
+def isRawNrrd(path):
+
+    if not (path.endswith('.nrrd') or path.endswith('.nhdr')):
+        return False
+    try:
+        fields, keyValues, dataFile, dataOffset = readNrrdHeader(path)
+    except (ValueError, OSError):
+        return False
+
+    return fields.get('encoding') == 'raw' and fields.get('type') in NRRD_TYPES
+
+
+#
+# Map the data of a raw NRRD file into memory (read only).
+# The array is in the C order, i.e. the axes are reversed from the NRRD
+# 'sizes' field: a 3D image is mapped as (z, y, x).
+# Returns a tuple (array, fields, keyValues).
+#
+def openNrrdMemmap(path):
+
+    fields, keyValues, dataFile, dataOffset = readNrrdHeader(path)
+
+    if fields.get('encoding') != 'raw':
+        raise ValueError('Only the raw encoding can be memory-mapped: %s' % path)
+    if not (fields.get('type') in NRRD_TYPES):
+        raise ValueError('Unsupported type "%s": %s' % (fields.get('type'), path))
+
+    dtype = numpy.dtype(NRRD_TYPES[fields['type']])
+    if dtype.itemsize > 1:
+        if fields.get('endian', 'little') == 'big':
+            dtype = dtype.newbyteorder('>')
+        else:
+            dtype = dtype.newbyteorder('<')
+
+    sizes = [int(x) for x in fields['sizes'].split()]
+    shape = tuple(reversed(sizes))
+
+    if dataOffset is None:
+        nbytes = int(numpy.prod(shape)) * dtype.itemsize
+        dataOffset = os.path.getsize(dataFile) - nbytes
+
+    array = numpy.memmap(dataFile, dtype=dtype, mode='r', offset=dataOffset, shape=shape)
+
+    return (array, fields, keyValues)
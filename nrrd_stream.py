@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import zlib
+import bz2
+
+import numpy
+import nrrd
+
+
+#  Sequential NRRD writer for dicom_to_nrrd.py
+#
+#  nrrd.write() needs the whole volume in memory. NrrdStreamWriter writes the
+#  header first (with the sizes known in advance) and then appends the data
+#  one chunk (e.g. one slice) at a time, so a volume of any size can be written
+#  with the memory of a single slice. The gzip and bzip2 encodings are
+#  compressed on the fly. The header is formatted in the same way as pynrrd.
+
+
+# NumPy data types and NRRD type names (same as pynrrd)
+NUMPY_TO_NRRD_TYPES = {
+    'i1' : 'int8',
+    'u1' : 'uint8',
+    'i2' : 'int16',
+    'u2' : 'uint16',
+    'i4' : 'int32',
+    'u4' : 'uint32',
+    'i8' : 'int64',
+    'u8' : 'uint64',
+    'f4' : 'float',
+    'f8' : 'double',
+    }
+
+# Order of the standard fields in the header (other fields are written as
+# key/value pairs)
+FIELD_ORDER = ['type', 'dimension', 'space dimension', 'space', 'sizes', 'space directions', 'kinds',
+               'endian', 'encoding', 'min', 'max', 'old min', 'old max', 'content', 'sample units',
+               'spacings', 'thicknesses', 'axis mins', 'axis maxs', 'centerings', 'labels', 'units',
+               'space units', 'space origin', 'measurement frame', 'data file']
+
+# Data file extensions for the detached header (.nhdr)
+DATA_FILE_EXTENSIONS = {
+    'raw'   : '.raw',
+    'gzip'  : '.raw.gz',
+    'bzip2' : '.raw.bz2',
+    }
+
+
+#
+# Format the value of a header field
+#
+def formatHeaderValue(field, value):
+
+    if field in ['space directions', 'measurement frame']:
+        return nrrd.format_optional_matrix(numpy.asarray(value, dtype=float))
+    if field == 'space origin':
+        return nrrd.format_optional_vector(numpy.asarray(value, dtype=float))
+    if isinstance(value, (list, tuple, numpy.ndarray)):
+        if all(isinstance(v, str) for v in value):
+            return ' '.join(value)
+        return nrrd.format_number_list(numpy.asarray(value))
+    return str(value)
+
+
+#
+# Write a NRRD header ('fields' in the order of FIELD_ORDER; other entries as
+# key/value pairs)
+#
+def writeHeader(fp, header):
+
+    fp.write(b'NRRD0005\n')
+    fp.write(b'# This NRRD file was generated by nrrd_stream.py\n')
+    fp.write(b'# on ' + time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()).encode('ascii') + b'(GMT).\n')
+    fp.write(b'# Complete NRRD file format specification at:\n')
+    fp.write(b'# http://teem.sourceforge.net/nrrd/format.html\n')
+    for field in FIELD_ORDER:
+        if field in header:
+            fp.write(('%s: %s\n' % (field, formatHeaderValue(field, header[field]))).encode('ascii'))
+    for field in header:
+        if not (field in FIELD_ORDER):
+            fp.write(('%s:=%s\n' % (field, formatHeaderValue(field, header[field]))).encode('ascii'))
+    fp.write(b'\n')
+
+
+class NrrdStreamWriter:
+
+    #
+    # Open '<path>.nrrd' (or '<path>.nhdr' and its data file when 'detached' is
+    # True) for an image of 'sizes' (NRRD order, fastest axis first) and 'dtype'.
+    # The type, dimension, sizes, endian, encoding and data file fields of
+    # 'header' are set from the arguments.
+    #
+    def __init__(self, path, header, dtype, sizes, encoding='raw', detached=False, compressionLevel=6):
+
+        self.dtype = numpy.dtype(dtype).newbyteorder('<')
+        self.nBytes = int(numpy.prod(sizes)) * self.dtype.itemsize
+        self.rawBytes = 0
+        self.writeTime = 0.0
+
+        header['type'] = NUMPY_TO_NRRD_TYPES[self.dtype.str[1:]]
+        header['dimension'] = len(sizes)
+        header['sizes'] = list(sizes)
+        if self.dtype.itemsize > 1:
+            header['endian'] = 'little'
+        header['encoding'] = encoding
+        header.pop('data file', None)
+
+        if detached:
+            self.files = [path + '.nhdr', path + DATA_FILE_EXTENSIONS[encoding]]
+            header['data file'] = os.path.basename(self.files[1])
+        else:
+            self.files = [path + '.nrrd']
+
+        if encoding == 'gzip':
+            self.compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        elif encoding == 'bzip2':
+            self.compressor = bz2.BZ2Compressor(compressionLevel)
+        elif encoding == 'raw':
+            self.compressor = None
+        else:
+            raise ValueError('Unknown encoding: %s' % encoding)
+
+        self.fp = open(self.files[0], 'wb')
+        writeHeader(self.fp, header)
+        if detached:
+            self.fp.close()
+            self.fp = open(self.files[1], 'wb')
+
+    #
+    # Append a chunk of data (an array whose first axis is the fastest, e.g. a
+    # (columns, rows) plane)
+    #
+    def write(self, array):
+
+        start = time.time()
+        data = numpy.asarray(array, dtype=self.dtype).tobytes(order='F')
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.fp.write(data)
+        self.rawBytes = self.rawBytes + array.size * self.dtype.itemsize
+        self.writeTime = self.writeTime + time.time() - start
+
+    #
+    # Close the file. Returns a dictionary with the list of files written, the
+    # size of the data ('rawBytes'), the size of the files ('fileBytes'), and
+    # the time spent in writing.
+    #
+    def close(self):
+
+        if self.compressor:
+            self.fp.write(self.compressor.flush())
+        self.fp.close()
+        if self.rawBytes != self.nBytes:
+            raise ValueError('%d bytes written to %s instead of %d' % (self.rawBytes, self.files[-1], self.nBytes))
+
+        return {
+            'files'     : self.files,
+            'rawBytes'  : self.rawBytes,
+            'fileBytes' : sum([os.path.getsize(f) for f in self.files]),
+            'writeTime' : self.writeTime,
+            }
+
+    #
+    # Close the file without validating the size of the data (e.g. after an
+    # error), and remove the files written
+    #
+    def abort(self):
+
+        self.fp.close()
+        for f in self.files:
+            if os.path.exists(f):
+                os.remove(f)
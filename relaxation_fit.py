@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import numpy
+
+
+#  Vectorized relaxation curve fitting for sample_intensities.py
+#
+#  All voxels (or ROIs) are fitted at once. For each model, the signal is linear
+#  in its amplitude parameters once the relaxation time T is fixed, so the fit
+#  first searches a dictionary of T values, solving the linear parameters in
+#  closed form for every voxel and every T, and then refines all parameters
+#  with a few batched Levenberg-Marquardt (damped Gauss-Newton) iterations.
+#
+#  Models (t: parameter, e.g. TI or TE):
+#   - 'ir-magnitude'        : S = |A (1 - B exp(-t/T1))|  (inversion recovery, magnitude)
+#   - 'ir-real'             : S =  A (1 - B exp(-t/T1))   (inversion recovery, real)
+#   - 'saturation-recovery' : S =  A (1 - exp(-t/T1))
+#   - 'exp-decay'           : S =  A exp(-t/T2)           (mono-exponential decay)
+#
+#  For the magnitude inversion recovery, the polarity of the first k points
+#  (in the order of t) is restored for every k, and the k that gives the smallest
+#  residual is selected.
+
+
+MODELS = {
+    'ir-magnitude'        : ['A', 'B', 'T1'],
+    'ir-real'             : ['A', 'B', 'T1'],
+    'saturation-recovery' : ['A', 'T1'],
+    'exp-decay'           : ['A', 'T2'],
+    }
+
+
+#
+# Evaluate the signed model (without magnitude) for parameters 'p' (voxel, param)
+# Returns a (voxel, t) array.
+#
+def modelSignal(model, t, p):
+
+    e = numpy.exp(-t[None, :] / p[:, -1:])
+    if model == 'ir-magnitude' or model == 'ir-real':
+        return p[:, 0:1] * (1.0 - p[:, 1:2] * e)
+    elif model == 'saturation-recovery':
+        return p[:, 0:1] * (1.0 - e)
+    elif model == 'exp-decay':
+        return p[:, 0:1] * e
+    raise ValueError('Unknown model: %s' % model)
+
+
+#
+# Jacobian of the signed model with respect to the parameters
+# Returns a (voxel, t, param) array.
+#
+def modelJacobian(model, t, p):
+
+    T = p[:, -1:]
+    e = numpy.exp(-t[None, :] / T)
+    dEdT = e * t[None, :] / (T * T)
+    if model == 'ir-magnitude' or model == 'ir-real':
+        A = p[:, 0:1]
+        B = p[:, 1:2]
+        return numpy.stack([1.0 - B * e, -A * e, -A * B * dEdT], axis=-1)
+    elif model == 'saturation-recovery':
+        A = p[:, 0:1]
+        return numpy.stack([1.0 - e, -A * dEdT], axis=-1)
+    elif model == 'exp-decay':
+        A = p[:, 0:1]
+        return numpy.stack([e, A * dEdT], axis=-1)
+    raise ValueError('Unknown model: %s' % model)
+
+
+#
+# Default dictionary of relaxation times: log-spaced from 1/10 of the smallest
+# positive t to 10 times the largest t
+#
+def defaultGrid(t, n=400):
+
+    positive = t[t > 0]
+    tMin = positive.min() if len(positive) > 0 else 1.0
+    return numpy.geomspace(0.1 * tMin, 10.0 * t.max(), n)
+
+
+#
+# Dictionary search. 'Y' is a (t, voxel) array with t sorted in ascending order.
+# Returns the initial parameters (voxel, param) and the signs (t, voxel) that
+# restore the polarity of the data.
+#
+def gridSearch(model, t, Y, grid):
+
+    nT, nV = Y.shape
+    E = numpy.exp(-t[None, :] / grid[:, None])    # (grid, t)
+    yy = numpy.sum(Y * Y, axis=0)                 # (voxel,)
+    signs = numpy.ones(Y.shape)
+
+    if model == 'saturation-recovery' or model == 'exp-decay':
+        # One basis function b(t): S = A b(t)
+        if model == 'saturation-recovery':
+            basis = 1.0 - E
+        else:
+            basis = E
+        by = basis @ Y                            # (grid, voxel)
+        bb = numpy.sum(basis * basis, axis=1)     # (grid,)
+        rss = yy[None, :] - by * by / bb[:, None]
+        best = numpy.argmin(rss, axis=0)
+        voxels = numpy.arange(nV)
+        A = by[best, voxels] / bb[best]
+        return (numpy.stack([A, grid[best]], axis=-1), signs)
+
+    # Inversion recovery: S = d0 + d1 exp(-t/T1), with A = d0 and B = -d1/d0
+    se  = numpy.sum(E, axis=1)[:, None]           # (grid, 1)
+    see = numpy.sum(E * E, axis=1)[:, None]
+    det = nT * see - se * se
+    s1  = numpy.sum(Y, axis=0)[None, :]           # (1, voxel)
+    sey = E @ Y                                   # (grid, voxel)
+
+    bestRSS = numpy.full(nV, numpy.inf)
+    bestD0 = numpy.zeros(nV)
+    bestD1 = numpy.zeros(nV)
+    bestT = numpy.zeros(nV)
+    bestK = numpy.zeros(nV, dtype=numpy.int64)
+    voxels = numpy.arange(nV)
+
+    nFlips = 1
+    if model == 'ir-magnitude':
+        nFlips = nT
+    for k in range(nFlips):
+        if k > 0:
+            # Restore the polarity of the k-th point (index k-1)
+            s1 = s1 - 2.0 * Y[k-1][None, :]
+            sey = sey - 2.0 * E[:, k-1:k] * Y[k-1][None, :]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            d0 = (see * s1 - se * sey) / det
+            d1 = (nT * sey - se * s1) / det
+            rss = yy[None, :] - (d0 * s1 + d1 * sey)
+        rss = numpy.where(numpy.isfinite(rss), rss, numpy.inf)
+        g = numpy.argmin(rss, axis=0)
+        r = rss[g, voxels]
+        update = r < bestRSS
+        bestRSS = numpy.where(update, r, bestRSS)
+        bestD0 = numpy.where(update, d0[g, voxels], bestD0)
+        bestD1 = numpy.where(update, d1[g, voxels], bestD1)
+        bestT = numpy.where(update, grid[g], bestT)
+        bestK = numpy.where(update, k, bestK)
+
+    signs = numpy.where(numpy.arange(nT)[:, None] < bestK[None, :], -1.0, 1.0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        B = numpy.where(bestD0 != 0, -bestD1 / bestD0, 0.0)
+
+    return (numpy.stack([bestD0, B, bestT], axis=-1), signs)
+
+
+#
+# Batched Levenberg-Marquardt refinement of the parameters 'p' (voxel, param)
+# for the signed data 'Y' (t, voxel)
+#
+def refine(model, t, Y, p, iterations=10):
+
+    y = Y.T
+    nP = p.shape[1]
+    damping = numpy.full(len(p), 1.0e-3)
+    rss = numpy.sum((y - modelSignal(model, t, p)) ** 2, axis=1)
+
+    for i in range(iterations):
+        J = modelJacobian(model, t, p)
+        r = y - modelSignal(model, t, p)
+        JTJ = numpy.einsum('vti,vtj->vij', J, J)
+        JTr = numpy.einsum('vti,vt->vi', J, r)
+        diag = numpy.einsum('vii->vi', JTJ)
+        H = JTJ + (damping[:, None] * diag + 1.0e-12)[:, :, None] * numpy.eye(nP)[None, :, :]
+        with numpy.errstate(all='ignore'):
+            try:
+                step = numpy.linalg.solve(H, JTr[:, :, None])[:, :, 0]
+            except numpy.linalg.LinAlgError:
+                break
+            pNew = p + step
+            rssNew = numpy.sum((y - modelSignal(model, t, pNew)) ** 2, axis=1)
+        accept = numpy.isfinite(rssNew) & (rssNew < rss) & (pNew[:, -1] > 0)
+        p = numpy.where(accept[:, None], pNew, p)
+        rss = numpy.where(accept, rssNew, rss)
+        damping = numpy.where(accept, damping * 0.1, damping * 10.0)
+
+    return (p, rss)
+
+
+#
+# Fit 'model' to the curves 'Y' (t, voxel) sampled at 't'.
+# Returns a dictionary with an array (voxel,) for each parameter of the model
+# (see MODELS) and 'RSS' (residual sum of squares).
+#
+def fitRelaxation(model, t, Y, grid=None, iterations=10, chunkSize=4096):
+
+    if not (model in MODELS):
+        raise ValueError('Unknown model: %s' % model)
+
+    t = numpy.asarray(t, dtype=numpy.float64)
+    Y = numpy.asarray(Y, dtype=numpy.float64)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    order = numpy.argsort(t, kind='stable')
+    t = t[order]
+    Y = Y[order]
+    if grid is None:
+        grid = defaultGrid(t)
+
+    names = MODELS[model]
+    nV = Y.shape[1]
+    result = {name: numpy.zeros(nV) for name in names}
+    result['RSS'] = numpy.zeros(nV)
+
+    # Voxels are processed in chunks to bound the size of the (grid, voxel) arrays
+    for start in range(0, nV, chunkSize):
+        end = min(start + chunkSize, nV)
+        Yc = Y[:, start:end]
+        p, signs = gridSearch(model, t, Yc, grid)
+        p, rss = refine(model, t, Yc * signs, p, iterations)
+        if model == 'ir-magnitude':
+            p[:, 0] = numpy.abs(p[:, 0])
+            rss = numpy.sum((numpy.abs(Yc.T) - numpy.abs(modelSignal(model, t, p))) ** 2, axis=1)
+        for i, name in enumerate(names):
+            result[name][start:end] = p[:, i]
+        result['RSS'][start:end] = rss
+
+    return result
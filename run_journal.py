@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+
+#  Run journal for resumable dicom_to_nrrd.py runs
+#
+#  For each output (series) written to the destination directory, the journal
+#  records a hash of its input files (paths, modification times and sizes),
+#  the export settings and the files written with their sizes. A series is up
+#  to date if the journal has the same input hash and settings, and all of its
+#  files exist with the recorded sizes. Each entry is committed as soon as the
+#  series is written, so a run that is interrupted can be resumed from the
+#  series that were not completed.
+
+
+JOURNAL_NAME = '.dicom_to_nrrd_journal.db'
+
+
+#
+# Hash of a list of input files. 'fileStats' maps each path to (mtime, size).
+# 'extra' (e.g. the volume values of a 4D series) is also hashed.
+#
+def inputHash(filelist, fileStats, extra=None):
+
+    h = hashlib.sha256()
+    for path in sorted(filelist):
+        mtime, size = fileStats.get(path, (None, None))
+        h.update(('%s\t%s\t%s\n' % (path, mtime, size)).encode('utf-8', 'surrogateescape'))
+    if extra != None:
+        h.update(json.dumps(extra).encode('utf-8'))
+    return h.hexdigest()
+
+
+class RunJournal:
+
+    #
+    # Open (or create) the journal in the destination directory 'dst'
+    #
+    def __init__(self, dst, name=JOURNAL_NAME):
+
+        self.dst = dst
+        self.con = sqlite3.connect(os.path.join(dst, name))
+        self.con.execute('CREATE TABLE IF NOT EXISTS journal (name text PRIMARY KEY, input_hash text, '
+                         'settings text, files text, finished real)')
+        self.con.commit()
+
+    #
+    # Check if the output 'name' is complete and up to date
+    #
+    def isComplete(self, name, inputHash, settings):
+
+        row = self.con.execute('SELECT input_hash,settings,files FROM journal WHERE name == ?', (name,)).fetchone()
+        if row == None or row[0] != inputHash or row[1] != settings:
+            return False
+        for file, size in json.loads(row[2]):
+            path = os.path.join(self.dst, file)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+        return True
+
+    #
+    # Record the output 'name' and its files (paths in the destination directory)
+    #
+    def record(self, name, inputHash, settings, files):
+
+        entries = [(os.path.basename(f), os.path.getsize(f)) for f in files]
+        self.con.execute('INSERT OR REPLACE INTO journal (name,input_hash,settings,files,finished) VALUES (?,?,?,?,?)',
+                         (name, inputHash, settings, json.dumps(entries), time.time()))
+        self.con.commit()
+
+    def close(self):
+
+        self.con.close()
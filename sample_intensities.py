@@ -5,28 +5,398 @@ import numpy
 import re
 import SimpleITK as sitk
 import json
+import io
+import glob
+import multiprocessing
+import functools
+import time
+import nrrd
 
+from relaxation_fit import MODELS, fitRelaxation
+from nrrd_mmap import isRawNrrd, openNrrdMemmap, readNrrdHeader
+from instrumentation import getInstrumentation, configureInstrumentation, collectInstrumentation, finishInstrumentation
+
+
+#
+# Statistics available in the output (name: column header)
+#
+STATISTICS = {
+    'count'    : 'Count',
+    'min'      : 'Min',
+    'max'      : 'Max',
+    'mean'     : 'Mean',
+    'stddev'   : 'StdDev',
+    'variance' : 'Variance',
+    'sum'      : 'Sum',
+    'median'   : 'Median',
+    'p05'      : 'P05',
+    'p25'      : 'P25',
+    'p75'      : 'P75',
+    'p95'      : 'P95',
+    }
+
+DEFAULT_STATISTICS = ['count', 'min', 'max', 'mean', 'stddev']
+
+
+#
+# Region of the ROIs (label != 0) in a label map, as a tuple (slabs, box):
+#   'slabs' : ranges (slices) along the first axis (the slowest on the disk)
+#             spanned by each label; the ranges that overlap or touch are
+#             merged, so two ROIs far apart give two thin slabs
+#   'box'   : bounding box (tuple of slices) of the ROIs along the other axes
+#
+def roiRegion(labelArray):
+
+    flat = labelArray.reshape(labelArray.shape[0], -1)
+    planeIndex, voxelIndex = numpy.nonzero(flat)
+    if len(planeIndex) == 0:
+        return ([], tuple([slice(0, 0)] * (labelArray.ndim - 1)))
+
+    # Range of each label along the first axis
+    labels, inverse = numpy.unique(flat[planeIndex, voxelIndex], return_inverse=True)
+    first = numpy.full(len(labels), labelArray.shape[0])
+    last = numpy.zeros(len(labels), dtype=int)
+    numpy.minimum.at(first, inverse, planeIndex)
+    numpy.maximum.at(last, inverse, planeIndex)
+
+    slabs = []
+    for start, stop in sorted(zip(first.tolist(), (last + 1).tolist())):
+        if slabs and start <= slabs[-1].stop:
+            slabs[-1] = slice(slabs[-1].start, max(stop, slabs[-1].stop))
+        else:
+            slabs.append(slice(start, stop))
+
+    box = []
+    position = numpy.unravel_index(voxelIndex, labelArray.shape[1:])
+    for p in position:
+        box.append(slice(int(p.min()), int(p.max()) + 1))
+
+    return (slabs, tuple(box))
+
+
+#
+# Extract the region (slabs, box) of an image (see roiRegion()). The slabs are
+# concatenated along the first axis, and only they are read from a
+# memory-mapped image.
+#
+def extractRegion(array, slabs, box):
+
+    if len(slabs) == 0:
+        return numpy.array(array[(slice(0, 0),) + box])
+    return numpy.concatenate([array[(slab,) + box] for slab in slabs], axis=0)
+
+
+#
+# Build the index of the ROIs in a label map (computed once per label map)
+#
+# Only the region (slabs, box) of the label map (see roiRegion(); default:
+# whole image) is indexed, and the images are sampled in the same region.
+# The flat indices of the voxels in the ROIs (label != 0) are sorted by label,
+# so the voxels of each ROI form a contiguous segment:
+#   'labels'    : label values
+#   'indices'   : flat voxel indices in the region, grouped by label
+#   'starts'    : start of the segment of each label in 'indices'
+#   'counts'    : number of voxels in each label
+#   'shape'     : shape of the region
+#   'slabs'     : ranges of the region along the first axis of the label map
+#   'box'       : region along the other axes of the label map
+#   'fullShape' : shape of the label map
+#
+def buildROIIndex(labelArray, region=None):
+
+    if region == None:
+        region = ([slice(0, labelArray.shape[0])], tuple([slice(0, n) for n in labelArray.shape[1:]]))
+    slabs, box = region
+    regionArray = extractRegion(labelArray, slabs, box)
+
+    flat = regionArray.ravel()
+    order = numpy.argsort(flat, kind='stable')
+    sortedLabels = flat[order]
+    inROI = sortedLabels != 0
+
+    indices = order[inROI]
+    labels, starts, counts = numpy.unique(sortedLabels[inROI], return_index=True, return_counts=True)
+
+    return {
+        'labels'    : labels,
+        'indices'   : indices,
+        'starts'    : starts,
+        'counts'    : counts,
+        'shape'     : regionArray.shape,
+        'slabs'     : slabs,
+        'box'       : box,
+        'fullShape' : labelArray.shape,
+        }
+
+
+#
+# Convert flat indices in the region of the ROI index to flat indices in the
+# label map
+#
+def labelMapIndices(roiIndex, indices):
+
+    position = numpy.unravel_index(indices, roiIndex['shape'])
+    planes = numpy.concatenate([numpy.arange(s.start, s.stop) for s in roiIndex['slabs']] + [numpy.zeros(0, dtype=int)])
+    position = (planes[position[0]],) + tuple([p + b.start for p, b in zip(position[1:], roiIndex['box'])])
+    return numpy.ravel_multi_index(position, roiIndex['fullShape'])
+
+
+#
+# Compute the statistics of each ROI from the voxel values gathered in the
+# order of roiIndex['indices']. 'values' is either a 1D array (one image) or a
+# 2D array (param, voxel); the statistics are computed along the last axis in
+# one vectorized pass. Returns a dictionary of arrays (one value per label).
+#
+def computeSegmentStatistics(values, roiIndex, statistics=DEFAULT_STATISTICS):
+
+    starts = roiIndex['starts']
+    counts = roiIndex['counts']
+    values = values.astype(numpy.float64, copy=False)
+    shape = values.shape[:-1] + (len(counts),)
+
+    result = {}
+    if len(counts) == 0:
+        for stat in statistics:
+            result[stat] = numpy.zeros(shape)
+        return result
+
+    sums = numpy.add.reduceat(values, starts, axis=-1)
+    means = sums / counts
+    result['count'] = numpy.broadcast_to(counts.astype(numpy.float64), shape)
+    result['sum']   = sums
+    result['mean']  = means
+
+    if 'stddev' in statistics or 'variance' in statistics:
+        deviations = values - numpy.repeat(means, counts, axis=-1)
+        sumSquares = numpy.add.reduceat(deviations * deviations, starts, axis=-1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            variances = numpy.where(counts > 1, sumSquares / (counts - 1), 0.0)
+        result['variance'] = variances
+        result['stddev']   = numpy.sqrt(variances)
+
+    if 'min' in statistics:
+        result['min'] = numpy.minimum.reduceat(values, starts, axis=-1)
+    if 'max' in statistics:
+        result['max'] = numpy.maximum.reduceat(values, starts, axis=-1)
+
+    percentiles = {'median': 50.0, 'p05': 5.0, 'p25': 25.0, 'p75': 75.0, 'p95': 95.0}
+    requested = [stat for stat in statistics if stat in percentiles]
+    if requested:
+        # Sort the values within each segment, and interpolate linearly
+        segment = numpy.broadcast_to(numpy.repeat(numpy.arange(len(counts)), counts), values.shape)
+        order = numpy.lexsort((values, segment), axis=-1)
+        sortedValues = numpy.take_along_axis(values, order, axis=-1)
+        for stat in requested:
+            position = starts + (counts - 1) * (percentiles[stat] / 100.0)
+            lower = numpy.floor(position).astype(numpy.int64)
+            upper = numpy.minimum(lower + 1, starts + counts - 1)
+            weight = position - lower
+            result[stat] = sortedValues[..., lower] * (1.0 - weight) + sortedValues[..., upper] * weight
+
+    return result
+
+
+#
+# Compute the statistics of the voxels in each ROI of 'imageArray'
+#
+def computeLabelStatistics(imageArray, roiIndex, statistics=DEFAULT_STATISTICS):
+
+    with getInstrumentation().stage('label stats', len(roiIndex['indices'])):
+        values = imageArray.ravel()[roiIndex['indices']]
+        return computeSegmentStatistics(values, roiIndex, statistics)
+
+
+#
+# Format the statistics of each ROI as CSV lines
+#
+def formatStatistics(param, roiIndex, result, statistics=DEFAULT_STATISTICS):
+
+    columns = [result[stat] for stat in statistics]
+    lines = []
+    for i, label in enumerate(roiIndex['labels']):
+        fields = ['%s' % param, '%d' % label] + ['%f' % c[i] for c in columns]
+        lines.append(','.join(fields) + '\n')
+
+    return ''.join(lines)
+
+
+#
+# Load a 4D NRRD file (see dicom_to_nrrd.py --4d) as a NumPy array
+# (volume, z, y, x). The last file is kept, so that its volumes are read or
+# decoded only once.
+#
+@functools.lru_cache(maxsize=1)
+def readImageFrames(path):
+
+    if isRawNrrd(path):
+        array, fields, keyValues = openNrrdMemmap(path)
+    else:
+        array, header = nrrd.read(path, index_order='C')
+    if array.ndim != 4:
+        raise ValueError('Not a 4D image: %s' % path)
+    return array
+
+
+#
+# Load an image as a NumPy array (z, y, x) in its native data type.
+# Raw-encoded NRRD files are memory-mapped, so that only the parts of the
+# image that are accessed are read from the disk. With 'frame', the volume
+# 'frame' of a 4D NRRD file is loaded.
+#
+def readImageArray(path, frame=None):
+
+    if frame != None:
+        return readImageFrames(path)[frame]
+
+    if isRawNrrd(path):
+        array, fields, keyValues = openNrrdMemmap(path)
+        return array
+
+    image = sitk.ReadImage(path)
+    return sitk.GetArrayFromImage(image)
+
+
+#
+# Load the region of the ROI index from an image. Returns None if the size of
+# the image does not match the label map.
+#
+def readImageRegion(path, roiIndex, frame=None):
+
+    start = time.time()
+    imageArray = readImageArray(path, frame)
+    if imageArray.shape != roiIndex['fullShape']:
+        print("ERROR: The size of the image does not match the label map: " + path)
+        return None
+
+    region = extractRegion(imageArray, roiIndex['slabs'], roiIndex['box'])
+    getInstrumentation().add('image read', time.time() - start, 1, region.nbytes, start)
+    return region
+
+
+#
+# Load the images (list of (path, frame); see imageSource()) into a single
+# (param, z, y, x) array. The array is allocated once, in memory or, if
+# 'memmapFile' is given, as a memory-mapped .npy file.
+# (Only the region of the ROI index is loaded.)
+#
+def loadImageStack(images, roiIndex, memmapFile=None):
+
+    stack = None
+    for i, (path, frame) in enumerate(images):
+        imageArray = readImageRegion(path, roiIndex, frame)
+        if imageArray is None:
+            return None
+        if stack is None:
+            stackShape = (len(images),) + tuple(roiIndex['shape'])
+            if memmapFile:
+                stack = numpy.lib.format.open_memmap(memmapFile, mode='w+', dtype=imageArray.dtype, shape=stackShape)
+            else:
+                stack = numpy.empty(stackShape, dtype=imageArray.dtype)
+        stack[i] = imageArray
+
+    return stack
+
+
+#
+# Save the per-voxel curves of the ROIs in a NumPy .npz file
+#   'params'  : parameter values (sorted)
+#   'labels'  : label values
+#   'counts'  : number of voxels in each label
+#   'indices' : flat voxel indices (in the label map), grouped by label
+#   'shape'   : shape of the label map (z, y, x)
+#   'curves'  : (param, voxel) array of intensities, voxels ordered as 'indices'
+#
+def saveCurves(curvesFile, params, roiIndex, curves):
+
+    numpy.savez(curvesFile,
+                params  = numpy.array([float(x) for x in params]),
+                labels  = roiIndex['labels'],
+                counts  = roiIndex['counts'],
+                indices = labelMapIndices(roiIndex, roiIndex['indices']),
+                shape   = numpy.array(roiIndex['fullShape']),
+                curves  = curves)
+
+
+#
+# Sort key of a frame label: the numeric labels by their values, then the
+# others in natural order (e.g. "TI2" before "TI10")
+#
+def frameLabelKey(label):
+
+    try:
+        return (0, float(label), [])
+    except ValueError:
+        parts = [(0, int(t), '') if t.isdigit() else (1, 0, t) for t in re.split(r'(\d+)', label) if t]
+        return (1, 0.0, parts)
+
+
+#
+# Check that the parameters are numeric (needed to save the curves and fit)
+#
+def isNumeric(params):
+
+    try:
+        [float(x) for x in params]
+    except ValueError:
+        return False
+    return True
 
-def sampleIntensity(imageListFile, sourceDir, outputFile):
-    
-    ### Open output file
-    outputFile = open(outputFile, 'w')
-    outputFile.write("Param,Index,Count,Min,Max,Mean,StdDev\n")
+
+#
+# Load the volumes of a 4D NRRD file exported by dicom_to_nrrd.py (--4d).
+# The parameters are taken from the "MultiVolume.FrameLabels" field (numeric
+# labels sorted by value, others in natural order; see frameLabelKey()). Returns
+# the same as loadImageList(), with (path, volume index) for each parameter.
+#
+def loadImageFrames(imageFile, labelFile=None):
+
+    fields, keyValues, dataFile, dataOffset = readNrrdHeader(imageFile)
+    sizes = fields.get('sizes', '').split()
+    kinds = fields.get('kinds', '').split()
+    if len(sizes) != 4 or len(kinds) != 4 or kinds[3] != 'list':
+        raise ValueError('Not a 4D image with a list axis: %s' % imageFile)
+    labels = keyValues.get('MultiVolume.FrameLabels', '').split(',')
+    if len(labels) != int(sizes[3]):
+        raise ValueError('The number of frame labels does not match the number of volumes: %s' % imageFile)
+
+    imageDict = {}
+    for i, label in enumerate(labels):
+        imageDict[label] = (imageFile, i)
+    params = sorted(labels, key=frameLabelKey)
+
+    return (labelFile, params, imageDict)
+
+
+#
+# Image file name (relative to 'sourceDir') or (path, volume index) in the
+# image dictionary to (path, volume index)
+#
+def imageSource(sourceDir, image):
+
+    if isinstance(image, tuple):
+        return image
+    return (os.path.join(sourceDir, image), None)
+
+
+#
+# Load the image list file. Returns the label map file name and the
+# parameters (sorted by their numeric values) with the image file names.
+# The image list file can also be a 4D NRRD file (see loadImageFrames()).
+# 'labelFile' overrides the label map in the list.
+#
+def loadImageList(imageListFile, labelFile=None):
+
+    if imageListFile.endswith('.nrrd') or imageListFile.endswith('.nhdr'):
+        return loadImageFrames(imageListFile, labelFile)
 
     ### Load the image file dictionary
     imageDict = None
     with open(imageListFile, "r") as read_file:
         imageDict = json.load(read_file)
-        
-    ### Load the label map
-    if 'label' in imageDict:
-        path = sourceDir + '/' + imageDict['label']
-        roiImage = sitk.ReadImage(path, sitk.sitkInt8)
-        # Remove the label map from the dictionary
-        del imageDict['label']
-    else:
-        print("ERROR: No label map is specified in the ")
-        return 0
+
+    label = imageDict.pop('label', None)
+    if labelFile == None:
+        labelFile = label
 
     ### Get a list of parameters (i.e., TI) and sort
     params = list(imageDict.keys())        # This is a string array
@@ -34,45 +404,362 @@ def sampleIntensity(imageListFile, sourceDir, outputFile):
     params_num, params = zip (*sorted(zip(params_num,params))) # Sort by params_num
     params = list(params)
 
-    for param in params:
-        path = sourceDir + '/' + imageDict[param]
-        image = sitk.ReadImage(path, sitk.sitkInt16)
-        
-        labelStatistics = sitk.LabelStatisticsImageFilter()
-        labelStatistics.Execute(image, roiImage)
-            
-        n = labelStatistics.GetNumberOfLabels()
+    return (labelFile, params, imageDict)
+
+
+#
+# Fit a relaxation model to the mean intensities of the ROIs, and write the
+# parameters in a CSV file
+#
+def fitROIMeans(fitFile, model, params, roiIndex, means):
+
+    t = numpy.array([float(x) for x in params])
+    result = fitRelaxation(model, t, means)
+    names = MODELS[model] + ['RSS']
+    with open(fitFile, 'w') as f:
+        f.write(','.join(['Index', 'Model'] + names) + '\n')
+        lines = []
+        for i, label in enumerate(roiIndex['labels']):
+            fields = ['%d' % label, model] + ['%f' % result[name][i] for name in names]
+            lines.append(','.join(fields) + '\n')
+        f.write(''.join(lines))
+
+
+#
+# Fit a relaxation model voxel by voxel, and write the parametric maps as NRRD
+# files ('<prefix>_<parameter>.nrrd') with the geometry of the label map.
+# 'indices' are the flat indices (in the region of the ROI index) of the voxels
+# in 'curves' (param, voxel).
+#
+def fitVoxels(mapPrefix, model, params, labelPath, roiIndex, indices, curves):
+
+    t = numpy.array([float(x) for x in params])
+    result = fitRelaxation(model, t, curves)
+
+    # Geometry of the label map (from the header only)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(labelPath)
+    reader.ReadImageInformation()
+
+    fullIndices = labelMapIndices(roiIndex, indices)
+    for name in MODELS[model] + ['RSS']:
+        parameterMap = numpy.zeros(roiIndex['fullShape'], dtype=numpy.float32)
+        parameterMap.ravel()[fullIndices] = result[name]
+        image = sitk.GetImageFromArray(parameterMap)
+        image.SetOrigin(reader.GetOrigin())
+        image.SetSpacing(reader.GetSpacing())
+        image.SetDirection(reader.GetDirection())
+        path = '%s_%s.nrrd' % (mapPrefix, name)
+        print('Writing ' + path)
+        sitk.WriteImage(image, path)
+
+
+#
+# Sample the intensities of the images in the image list file, and write the
+# statistics to 'outputFile' (a file object) in the CSV format.
+# Returns True if all images have been sampled.
+#
+def writeIntensities(imageListFile, sourceDir, outputFile, statistics=DEFAULT_STATISTICS,
+                     stack=False, memmapFile=None, curvesFile=None,
+                     fitModel=None, fitFile=None, mapPrefix=None, fitAll=False, labelFile=None):
+    
+    outputFile.write(','.join(['Param', 'Index'] + [STATISTICS[stat] for stat in statistics]) + '\n')
+
+    ### Load the image file dictionary
+    labelFile, params, imageDict = loadImageList(imageListFile, labelFile)
+    if (curvesFile or fitModel) and not isNumeric(params):
+        print("ERROR: The parameters must be numeric to save the curves or fit a model: %s" % ', '.join(params))
+        return False
         
-        for i in range(1,n):
-            outputFile.write("%s," % param)                         # Param (i.e., TI, Time, ..)
-            outputFile.write("%d," % i)                             # Index
-            outputFile.write("%f," % labelStatistics.GetCount(i))   # Count
-            outputFile.write("%f," % labelStatistics.GetMinimum(i)) # Min
-            outputFile.write("%f," % labelStatistics.GetMaximum(i)) # Max
-            outputFile.write("%f," % labelStatistics.GetMean(i))    # Mean
-            outputFile.write("%f\n"% labelStatistics.GetSigma(i))   # StdDev
+    ### Load the label map and index the ROIs
+    # Only the slabs that contain the ROIs are read from the images, unless all
+    # voxels are fitted.
+    if labelFile:
+        labelPath = os.path.join(sourceDir, labelFile)
+        labelArray = readImageArray(labelPath)
+        region = None
+        if not (mapPrefix and fitAll):
+            region = roiRegion(labelArray)
+        roiIndex = buildROIIndex(labelArray, region)
+    else:
+        print("ERROR: No label map is specified in the ")
+        return False
+
+    # The mean intensities are needed to fit the ROIs
+    computed = list(statistics)
+    if fitModel and not ('mean' in computed):
+        computed.append('mean')
+    means = []
+    nSampled = 0
+
+    if stack or memmapFile or curvesFile or mapPrefix:
+        ### Load all images into one array, and gather the voxels of the ROIs at once
+        images = [imageSource(sourceDir, imageDict[param]) for param in params]
+        stackArray = loadImageStack(images, roiIndex, memmapFile)
+        if stackArray is None:
+            return False
+        with getInstrumentation().stage('label stats', len(params) * len(roiIndex['indices'])):
+            curves = stackArray.reshape((len(params), -1))[:, roiIndex['indices']]
+            result = computeSegmentStatistics(curves, roiIndex, computed)
+        for i, param in enumerate(params):
+            resultParam = {stat: result[stat][i] for stat in computed}
+            outputFile.write(formatStatistics(param, roiIndex, resultParam, statistics))
+        means = result['mean']
+        nSampled = len(params)
+        if curvesFile:
+            saveCurves(curvesFile, params, roiIndex, curves)
+        if mapPrefix:
+            with getInstrumentation().stage('fit'):
+                if fitAll:
+                    indices = numpy.arange(stackArray[0].size)
+                    fitVoxels(mapPrefix, fitModel, params, labelPath, roiIndex, indices, stackArray.reshape((len(params), -1)))
+                else:
+                    fitVoxels(mapPrefix, fitModel, params, labelPath, roiIndex, roiIndex['indices'], curves)
+    else:
+        for param in params:
+            path, frame = imageSource(sourceDir, imageDict[param])
+            imageArray = readImageRegion(path, roiIndex, frame)
+            if imageArray is None:
+                continue
+
+            result = computeLabelStatistics(imageArray, roiIndex, computed)
+            outputFile.write(formatStatistics(param, roiIndex, result, statistics))
+            means.append(result['mean'])
+            nSampled = nSampled + 1
+
+    if nSampled != len(params):
+        if fitModel and fitFile:
+            print("ERROR: Cannot fit the ROIs as some of the images could not be sampled.")
+        return False
+
+    if fitModel and fitFile:
+        with getInstrumentation().stage('fit'):
+            fitROIMeans(fitFile, fitModel, params, roiIndex, numpy.array(means))
+
+    return True
+
+
+def sampleIntensity(imageListFile, sourceDir, outputFile, statistics=DEFAULT_STATISTICS,
+                    stack=False, memmapFile=None, curvesFile=None,
+                    fitModel=None, fitFile=None, mapPrefix=None, fitAll=False, labelFile=None):
+
+    ### Open output file
+    with open(outputFile, 'w') as f:
+        return writeIntensities(imageListFile, sourceDir, f, statistics,
+                                stack, memmapFile, curvesFile,
+                                fitModel, fitFile, mapPrefix, fitAll, labelFile)
 
             
+#
+# Load a manifest file for the batch mode. Each line lists an image list file,
+# a source directory and, optionally, an output file for the study:
+#
+#   LIST_FILE SRC_DIR [OUTPUT_FILE]
+#
+# Relative paths are relative to the directory of the manifest file. Empty lines
+# and lines starting with '#' are ignored.
+#
+def loadManifest(manifestFile):
+
+    baseDir = os.path.dirname(manifestFile)
+    studies = []
+    with open(manifestFile) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            if len(fields) < 2 or len(fields) > 3:
+                sys.exit('ERROR: Invalid line in the manifest file: %s' % line.strip())
+            fields = [os.path.join(baseDir, x) for x in fields]
+            study = {'listFile': fields[0], 'sourceDir': fields[1], 'output': None}
+            if len(fields) == 3:
+                study['output'] = fields[2]
+            studies.append(study)
+
+    return studies
+
+
+#
+# List the studies for the batch mode from a glob pattern of image list files.
+# The images are in the same directory as the image list file.
+#
+def listStudies(pattern):
+
+    studies = []
+    for listFile in sorted(glob.glob(pattern)):
+        studies.append({'listFile': listFile, 'sourceDir': os.path.dirname(listFile) or '.', 'output': None})
+
+    return studies
+
+
+#
+# Sample the intensities of a study (Called in a worker process.)
+# Returns the study with the CSV text ('table') or the error message ('error'),
+# and the instrumentation data ('instrumentation').
+# Any failure is confined to the study.
+#
+def sampleStudy(args):
+
+    study, statistics, stack, labelFile = args
+    study = dict(study)
+    study['table'] = None
+    study['error'] = None
+    with collectInstrumentation() as instrumentation:
+        try:
+            output = io.StringIO()
+            if writeIntensities(study['listFile'], study['sourceDir'], output, statistics, stack, labelFile=labelFile):
+                study['table'] = output.getvalue()
+                if study['output']:
+                    with open(study['output'], 'w') as f:
+                        f.write(study['table'])
+            else:
+                study['error'] = 'some of the images could not be sampled'
+        except Exception as e:
+            study['error'] = '%s: %s' % (type(e).__name__, e)
+    study['instrumentation'] = instrumentation.data()
+
+    return study
+
+
+#
+# Quote a field for the CSV format, if necessary
+#
+def quoteField(value):
+
+    if ',' in value or '"' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+#
+# Sample the intensities of multiple studies in a pool of nJobs processes, and
+# consolidate the statistics into one table (in the long format) with the
+# study (image list file) as the first column.
+# Returns the number of studies that failed.
+#
+def sampleBatch(studies, outputFile, statistics=DEFAULT_STATISTICS, stack=False, nJobs=1, labelFile=None):
+
+    tasks = [(study, statistics, stack, labelFile) for study in studies]
+    if nJobs > 1:
+        pool = multiprocessing.Pool(nJobs)
+        results = pool.imap(sampleStudy, tasks)
+    else:
+        pool = None
+        results = map(sampleStudy, tasks)
+
+    instrumentation = getInstrumentation()
+    instrumentation.startProgress('Studies', len(studies))
+    failed = []
+    with open(outputFile, 'w') as f:
+        f.write(','.join(['Study', 'Param', 'Index'] + [STATISTICS[stat] for stat in statistics]) + '\n')
+        for study in results:
+            instrumentation.merge(study['instrumentation'])
+            instrumentation.advance()
+            if study['error']:
+                print('ERROR: %s: %s' % (study['listFile'], study['error']))
+                failed.append(study)
+                continue
+            instrumentation.log('Sampled %s' % study['listFile'])
+            prefix = quoteField(study['listFile']) + ','
+            lines = study['table'].splitlines(True)[1:]
+            f.write(''.join([prefix + line for line in lines]))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    instrumentation.finishProgress()
+    print('%d studies sampled, %d failed' % (len(studies) - len(failed), len(failed)))
+
+    return len(failed)
+
+
 def main(argv):
     
     try:
         parser = argparse.ArgumentParser(description="Split DICOM series by Tag.")
-        parser.add_argument('flist', metavar='LIST_FILE', type=str, nargs=1,
-                            help='Image list file (in the JSON format)')
-        parser.add_argument('src', metavar='SRC_DIR', type=str, nargs=1,
-                            help='Source directory')
-        parser.add_argument('out', metavar='OUTPUT_FILE', type=str, nargs=1,
-                            help='Output file')
+        parser.add_argument('files', metavar='LIST_FILE SRC_DIR OUTPUT_FILE', type=str, nargs='+',
+                            help='Image list file (in the JSON format, or a 4D NRRD file exported with dicom_to_nrrd.py --4d),'
+                            ' source directory and output file (only OUTPUT_FILE with --manifest or --glob)')
+        parser.add_argument('--label', dest='label', type=str, default=None,
+                            help='label map file in SRC_DIR (required for a 4D NRRD file; overrides "label" in the image list)')
+        parser.add_argument('-s', '--stats', dest='stats', type=str, default=','.join(DEFAULT_STATISTICS),
+                            help='comma-separated list of statistics (%s) (default: %s)'
+                            % (','.join(STATISTICS.keys()), ','.join(DEFAULT_STATISTICS)))
+        parser.add_argument('--stack', dest='stack', action='store_const',
+                            const=True, default=False,
+                            help='load all images into one (param, z, y, x) array and sample them at once')
+        parser.add_argument('--memmap', dest='memmap', type=str, default=None,
+                            help='keep the image stack in a memory-mapped .npy file (implies --stack)')
+        parser.add_argument('--curves', dest='curves', type=str, default=None,
+                            help='save the per-voxel intensity curves of the ROIs in a .npz file (implies --stack)')
+        parser.add_argument('--fit', dest='fit', type=str, default=None, choices=list(MODELS.keys()),
+                            help='fit a relaxation model to the mean intensities of the ROIs (parameters: keys of the image list)')
+        parser.add_argument('--fit-csv', dest='fitCSV', type=str, default=None,
+                            help='output file for the ROI fit (default: OUTPUT_FILE with suffix "_fit.csv")')
+        parser.add_argument('--fit-maps', dest='fitMaps', type=str, default=None,
+                            help='fit the model voxel by voxel and save the parametric maps as PREFIX_<parameter>.nrrd (implies --stack)')
+        parser.add_argument('--fit-all', dest='fitAll', action='store_const',
+                            const=True, default=False,
+                            help='fit all voxels, instead of the voxels in the ROIs (with --fit-maps)')
+        parser.add_argument('--manifest', dest='manifest', type=str, default=None,
+                            help='batch mode: file listing "LIST_FILE SRC_DIR [OUTPUT_FILE]" for each study')
+        parser.add_argument('--glob', dest='glob', type=str, default=None,
+                            help='batch mode: glob pattern of image list files (images in the same directories)')
+        parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                            help='number of processes to sample the studies in the batch mode (0: number of CPUs)')
+        parser.add_argument('-q', '--quiet', dest='quiet', action='store_const',
+                            const=True, default=False,
+                            help='do not list the studies in the batch mode; show a progress bar instead')
+        parser.add_argument('--profile', dest='profile', type=str, default=None, metavar='FILE',
+                            help='report the time spent in each stage, and write the profile and trace to a JSON file')
         args = parser.parse_args(argv)
 
     except Exception as e:
         print(e)
 
-    listfile = args.flist[0]
-    srcdir = args.src[0]
-    outfile = args.out[0]
+    configureInstrumentation(args.quiet, args.profile)
+    statistics = args.stats.split(',')
+    for stat in statistics:
+        if not (stat in STATISTICS):
+            sys.exit('ERROR: Unknown statistic: %s' % stat)
+
+    if args.manifest or args.glob:
+        if len(args.files) != 1:
+            sys.exit('ERROR: Only OUTPUT_FILE must be specified in the batch mode.')
+        if args.memmap or args.curves or args.fit or args.fitMaps:
+            sys.exit('ERROR: --memmap, --curves and --fit* are not available in the batch mode.')
+        studies = []
+        if args.manifest:
+            studies = studies + loadManifest(args.manifest)
+        if args.glob:
+            studies = studies + listStudies(args.glob)
+        nJobs = args.jobs
+        if nJobs <= 0:
+            nJobs = os.cpu_count()
+        nFailed = sampleBatch(studies, args.files[0], statistics, args.stack, nJobs, args.label)
+        finishInstrumentation(args.profile)
+        sys.exit(1 if nFailed > 0 else 0)
+
+    if len(args.files) != 3:
+        sys.exit('ERROR: LIST_FILE, SRC_DIR and OUTPUT_FILE must be specified.')
+    listfile = args.files[0]
+    srcdir = args.files[1]
+    outfile = args.files[2]
+
+    if (listfile.endswith('.nrrd') or listfile.endswith('.nhdr')) and not args.label:
+        sys.exit('ERROR: --label is required for a 4D NRRD file.')
+    if args.fitMaps and not args.fit:
+        sys.exit('ERROR: --fit-maps requires --fit MODEL')
+    fitFile = args.fitCSV
+    if args.fit and not fitFile:
+        fitFile = os.path.splitext(outfile)[0] + '_fit.csv'
 
-    sampleIntensity(listfile, srcdir, outfile)
+    sampleIntensity(listfile, srcdir, outfile, statistics,
+                    stack=args.stack, memmapFile=args.memmap, curvesFile=args.curves,
+                    fitModel=args.fit, fitFile=fitFile, mapPrefix=args.fitMaps, fitAll=args.fitAll,
+                    labelFile=args.label)
+    finishInstrumentation(args.profile)
     
     sys.exit()
 
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+import re
+import ast
+
+import numpy
+import pydicom.datadict
+from pydicom.multival import MultiValue
+
+
+#  Filter expressions on DICOM attributes for dicom_list_by_tag.py and
+#  dicom_to_nrrd.py
+#
+#  An expression is compiled once (compileFilter()) and then evaluated either
+#  on each DICOM header (TagFilter.matches()), or at once on the columns of the
+#  file index (TagFilter.evaluate()), where each condition is tested only on the
+#  distinct values of a column and the results are combined with NumPy.
+#
+#  Syntax:
+#    EXPR       := EXPR or EXPR | EXPR and EXPR | not EXPR | ( EXPR ) | CONDITION
+#    CONDITION  := FIELD == VALUE | FIELD != VALUE | FIELD < VALUE | FIELD <= VALUE
+#                | FIELD > VALUE | FIELD >= VALUE
+#                | FIELD ~ REGEX            (regular expression search)
+#                | FIELD contains VALUE     (substring)
+#                | FIELD in MIN..MAX        (numeric range, inclusive)
+#                | FIELD in (VALUE, ...)    (one of the values)
+#                | FIELD exists             (the element is present and not empty)
+#    FIELD      := TAG | TAG[INDEX]         (INDEX: 0-based index of a multi-valued element)
+#    TAG        := 8 hex digits (e.g. 00180082) or keyword (e.g. InversionTime)
+#    VALUE      := number, "quoted string" or word (e.g. R/DIS2D)
+#
+#  Numbers are compared numerically (values that are not numbers do not match);
+#  strings are compared as strings. A condition on a multi-valued element without
+#  an index is true if any of the values satisfies it. "!=" is the negation of
+#  "==", and is therefore true for missing elements.
+#
+#  Example:
+#    "InversionTime in 100..1000 and 00511016 == R/DIS2D and not 00080008 contains LOCALIZER"
+
+
+TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+   |(?P<op>==|!=|<=|>=|\.\.|[<>=~(),\[\]])
+   |(?P<word>(?:[^\s"'<>=!~(),\[\].]|\.(?!\.))+)
+   )''', re.VERBOSE)
+
+OPERATORS = ['==', '=', '!=', '<', '<=', '>', '>=', '~', 'contains']
+
+ITEM_RE = re.compile(r'''"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[^,\s][^,]*''')
+
+
+#
+# Split an expression into tokens (kind, text)
+#
+def tokenize(text):
+
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if m == None or m.end() == pos:
+            raise ValueError('Invalid filter expression at "%s"' % text[pos:])
+        pos = m.end()
+        for kind in ['string', 'op', 'word']:
+            if m.group(kind) != None:
+                tokens.append((kind, m.group(kind)))
+                break
+
+    return tokens
+
+
+#
+# Convert a tag (8 hex digits or keyword) to an integer tag
+#
+def parseTag(word):
+
+    if re.fullmatch(r'(0x)?[0-9A-Fa-f]{8}', word):
+        return int(word, 16)
+    tag = pydicom.datadict.tag_for_keyword(word)
+    if tag == None:
+        raise ValueError('Unknown DICOM tag or keyword: %s' % word)
+    return tag
+
+
+#
+# Convert a number to float, or None if it is not a number
+#
+def toNumber(s):
+
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return None
+
+
+#
+# Values of an element in the header as a list of strings ([] if missing or empty)
+#
+def datasetComponents(dataset, tag):
+
+    if not (tag in dataset):
+        return []
+    value = dataset[tag].value
+    if value == None:
+        return []
+    if isinstance(value, (MultiValue, list, tuple)):
+        return [str(v) for v in value]
+    s = str(value)
+    if s == '':
+        return []
+    return [s]
+
+
+#
+# Values of an element recorded in the file index (str() of the element value;
+# multi-valued elements look like "[0.5, 0.5]" or "['ORIGINAL', 'PRIMARY']")
+# as a list of strings
+#
+def indexComponents(s):
+
+    if s == None or s == '':
+        return []
+    if len(s) >= 2 and s[0] == '[' and s[-1] == ']':
+        components = []
+        for item in ITEM_RE.findall(s[1:-1]):
+            item = item.strip()
+            if item[:1] in ['"', "'"]:
+                try:
+                    item = ast.literal_eval(item)
+                except (ValueError, SyntaxError):
+                    item = item[1:-1]
+            components.append(item)
+        return components
+    return [s]
+
+
+#
+# Condition on a single element
+#
+class Condition:
+
+    def __init__(self, tag, index, op, values):
+        self.tag = tag
+        self.index = index
+        self.op = op
+        self.values = values     # list of (string, number or None)
+        self.regex = None
+        if op == '~':
+            try:
+                self.regex = re.compile(values[0][0])
+            except re.error as e:
+                raise ValueError('Invalid regular expression "%s" in filter expression: %s' % (values[0][0], e))
+
+    def testValue(self, s):
+        if self.op == 'range':
+            x = toNumber(s)
+            return x != None and self.values[0][1] <= x <= self.values[1][1]
+        if self.op == '~':
+            return self.regex.search(s) != None
+        if self.op == 'contains':
+            return self.values[0][0] in s
+        for text, number in self.values:
+            if number != None:
+                x = toNumber(s)
+                if x == None:
+                    continue
+                a, b = x, number
+            else:
+                a, b = s.strip(), text
+            if self.op == '==' or self.op == 'in':
+                result = (a == b)
+            elif self.op == '<':
+                result = (a < b)
+            elif self.op == '<=':
+                result = (a <= b)
+            elif self.op == '>':
+                result = (a > b)
+            elif self.op == '>=':
+                result = (a >= b)
+            if result:
+                return True
+        return False
+
+    # Test the list of the values of the element
+    def test(self, components):
+        if self.index != None:
+            if self.index < len(components):
+                components = [components[self.index]]
+            else:
+                components = []
+        if self.op == 'exists':
+            return len(components) > 0
+        return any(self.testValue(s) for s in components)
+
+    def matches(self, dataset):
+        return self.test(datasetComponents(dataset, self.tag))
+
+    def evaluate(self, columns, cache):
+        if not (self.tag in cache):
+            column = numpy.asarray(columns[self.tag], dtype=str)
+            uniques, inverse = numpy.unique(column, return_inverse=True)
+            cache[self.tag] = (uniques, inverse.reshape(-1), [indexComponents(u) for u in uniques])
+        uniques, inverse, components = cache[self.tag]
+        result = numpy.array([self.test(c) for c in components], dtype=bool)
+        return result[inverse]
+
+    def tags(self):
+        return {self.tag}
+
+
+class Not:
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def matches(self, dataset):
+        return not self.operand.matches(dataset)
+
+    def evaluate(self, columns, cache):
+        return ~self.operand.evaluate(columns, cache)
+
+    def tags(self):
+        return self.operand.tags()
+
+
+class And:
+
+    def __init__(self, operands):
+        self.operands = operands
+
+    def matches(self, dataset):
+        return all(o.matches(dataset) for o in self.operands)
+
+    def evaluate(self, columns, cache):
+        result = self.operands[0].evaluate(columns, cache)
+        for o in self.operands[1:]:
+            result = result & o.evaluate(columns, cache)
+        return result
+
+    def tags(self):
+        return set().union(*[o.tags() for o in self.operands])
+
+
+class Or(And):
+
+    def matches(self, dataset):
+        return any(o.matches(dataset) for o in self.operands)
+
+    def evaluate(self, columns, cache):
+        result = self.operands[0].evaluate(columns, cache)
+        for o in self.operands[1:]:
+            result = result | o.evaluate(columns, cache)
+        return result
+
+
+#
+# Recursive descent parser
+#
+class Parser:
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] == None:
+            raise ValueError('Unexpected end of filter expression')
+        self.pos = self.pos + 1
+        return token
+
+    def isWord(self, word):
+        kind, text = self.peek()
+        return kind == 'word' and text.lower() == word
+
+    def expect(self, op):
+        kind, text = self.next()
+        if kind != 'op' or text != op:
+            raise ValueError('Expected "%s" but found "%s" in filter expression' % (op, text))
+
+    def parse(self):
+        node = self.parseOr()
+        if self.pos < len(self.tokens):
+            raise ValueError('Unexpected "%s" in filter expression' % self.tokens[self.pos][1])
+        return node
+
+    def parseOr(self):
+        operands = [self.parseAnd()]
+        while self.isWord('or'):
+            self.next()
+            operands.append(self.parseAnd())
+        if len(operands) == 1:
+            return operands[0]
+        return Or(operands)
+
+    def parseAnd(self):
+        operands = [self.parseNot()]
+        while self.isWord('and'):
+            self.next()
+            operands.append(self.parseNot())
+        if len(operands) == 1:
+            return operands[0]
+        return And(operands)
+
+    def parseNot(self):
+        if self.isWord('not'):
+            self.next()
+            return Not(self.parseNot())
+        if self.peek() == ('op', '('):
+            self.next()
+            node = self.parseOr()
+            self.expect(')')
+            return node
+        return self.parseCondition()
+
+    def parseValue(self):
+        kind, text = self.next()
+        if kind == 'string':
+            return (ast.literal_eval(text), None)
+        if kind == 'word':
+            return (text, toNumber(text))
+        raise ValueError('Expected a value but found "%s" in filter expression' % text)
+
+    def parseCondition(self):
+        kind, text = self.next()
+        if kind != 'word':
+            raise ValueError('Expected a tag but found "%s" in filter expression' % text)
+        tag = parseTag(text)
+        index = None
+        if self.peek() == ('op', '['):
+            self.next()
+            kind, text = self.next()
+            if kind != 'word' or not text.isdigit():
+                raise ValueError('Invalid index "%s" in filter expression' % text)
+            index = int(text)
+            self.expect(']')
+
+        kind, op = self.next()
+        op = op.lower() if kind == 'word' else op
+        if op == 'exists':
+            return Condition(tag, index, 'exists', [])
+        if op == 'in':
+            if self.peek() == ('op', '('):
+                self.next()
+                values = [self.parseValue()]
+                while self.peek() == ('op', ','):
+                    self.next()
+                    values.append(self.parseValue())
+                self.expect(')')
+                return Condition(tag, index, 'in', values)
+            low = self.parseValue()
+            self.expect('..')
+            high = self.parseValue()
+            if low[1] == None or high[1] == None:
+                raise ValueError('A range must be numeric (MIN..MAX) in filter expression')
+            return Condition(tag, index, 'range', [low, high])
+        if not (op in OPERATORS):
+            raise ValueError('Unknown operator "%s" in filter expression' % op)
+        if op == '=':
+            op = '=='
+        value = self.parseValue()
+        if op == '!=':
+            return Not(Condition(tag, index, '==', [value]))
+        return Condition(tag, index, op, [value])
+
+
+#
+# Compiled filter expression
+#   - tags       : set of the (integer) tags used in the expression
+#   - matches()  : evaluate the expression on a DICOM dataset
+#   - evaluate() : evaluate the expression on columns of values as recorded in
+#                  the file index ({tag: sequence of strings}); returns a
+#                  boolean array
+#
+class TagFilter:
+
+    def __init__(self, text):
+        self.text = text
+        self.root = Parser(text).parse()
+        self.tags = self.root.tags()
+
+    def matches(self, dataset):
+        return self.root.matches(dataset)
+
+    def evaluate(self, columns):
+        return self.root.evaluate(columns, {})
+
+
+#
+# Compile a filter expression (raises ValueError for invalid expressions)
+#
+def compileFilter(text):
+
+    return TagFilter(text)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import os
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ImplicitVRLittleEndian, MRImageStorage, generate_uid
+
+from dicom_header import readDICOMHeader, privateCreatorTag
+import dicom_to_nrrd
+import dicom_separate_by_tag
+
+
+#  Tests of the header-only reads on synthetic files (run with pytest)
+
+
+#
+# Write an implicit VR file with a Siemens private element (0051,1016)
+#
+def writePrivateFile(dst):
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MRImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.SeriesNumber = 3
+    block = ds.private_block(0x0051, 'SIEMENS MR HEADER', create=True)
+    block.add_new(0x16, 'LO', 'R/DIS2D')
+    path = os.path.join(dst, 'IM0001')
+    ds.save_as(path, implicit_vr=True, little_endian=True, enforce_file_format=True)
+
+    return path
+
+
+def test_private_creator_tag():
+
+    assert privateCreatorTag(0x00511016) == 0x00510010
+    assert privateCreatorTag(0x0051100F) == 0x00510010
+    assert privateCreatorTag(0x00200011) == None
+    assert privateCreatorTag(0x00510010) == None
+
+
+def test_read_private_tag(tmp_path):
+
+    path = writePrivateFile(str(tmp_path))
+    dataset, nbytes = readDICOMHeader(path, ['00511016'])
+    assert dataset['00511016'].value == 'R/DIS2D'
+
+
+def test_private_tag_attributes(tmp_path):
+
+    path = writePrivateFile(str(tmp_path))
+    assert dicom_to_nrrd.getDICOMAttribute(path, ['0020,0011', '0051,1016']) == ('3', 'R/DIS2D')
+    assert dicom_separate_by_tag.getDICOMAttributes(path, ['00511016', '00200011']) == ['R/DIS2D', 3]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import os
+
+import numpy as np
+import pytest
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+import nrrd
+
+import dicom_to_nrrd
+
+
+#  Tests of dicom_to_nrrd.py on small synthetic series (run with pytest)
+
+
+#
+# Write a series of 'nSlices' 16-bit slices with 'bitsStored' bits to 'dst'.
+# The bits above BitsStored are filled with junk. Returns the list of files.
+#
+def writeSeries(dst, nSlices=3, rows=8, columns=6, bitsStored=12, pixelRepresentation=0,
+                slope=1, intercept=0, seed=0):
+
+    rng = np.random.default_rng(seed)
+    dtype = np.int16 if pixelRepresentation == 1 else np.uint16
+    files = []
+    for z in range(nSlices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = MRImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = z + 1
+        ds.ImagePositionPatient = [0.0, 0.0, 2.0 * z]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [0.5, 0.5]
+        ds.SliceThickness = 2.0
+        ds.SliceLocation = 2.0 * z
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.BitsAllocated = 16
+        ds.BitsStored = bitsStored
+        ds.HighBit = bitsStored - 1
+        ds.PixelRepresentation = pixelRepresentation
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.RescaleSlope = slope
+        ds.RescaleIntercept = intercept
+        raw = rng.integers(0, 1 << 16, (rows, columns), dtype=np.uint16)
+        ds.PixelData = raw.astype(dtype).tobytes()
+        path = os.path.join(dst, 'IM%04d' % z)
+        ds.save_as(path, enforce_file_format=True)
+        files.append(path)
+
+    return files
+
+
+#
+# Reference volume: pixel_array (which masks the bits above BitsStored) rescaled
+#
+def referenceVolume(files):
+
+    planes = []
+    for path in files:
+        ds = pydicom.dcmread(path)
+        planes.append(np.transpose(ds.pixel_array * float(ds.RescaleSlope) + float(ds.RescaleIntercept)))
+    return np.stack(planes, axis=2)
+
+
+def test_high_bits_unsigned(tmp_path):
+
+    files = writeSeries(str(tmp_path))
+    written = dicom_to_nrrd.exportNrrd(files, str(tmp_path), 'out')
+    data, header = nrrd.read(written['files'][0])
+    assert data.max() < 4096
+    assert np.array_equal(data, referenceVolume(files))
+
+
+def test_high_bits_signed(tmp_path):
+
+    files = writeSeries(str(tmp_path), pixelRepresentation=1)
+    written = dicom_to_nrrd.exportNrrd(files, str(tmp_path), 'out')
+    data, header = nrrd.read(written['files'][0])
+    assert -2048 <= data.min() and data.max() < 2048
+    assert np.array_equal(data, referenceVolume(files))
+
+
+def test_high_bits_stream(tmp_path):
+
+    files = writeSeries(str(tmp_path))
+    written = dicom_to_nrrd.exportNrrd(files, str(tmp_path), 'out', stream=True)
+    data, header = nrrd.read(written['files'][0])
+    assert np.array_equal(data, referenceVolume(files))
+
+
+def test_stream_error(tmp_path, monkeypatch):
+
+    files = writeSeries(str(tmp_path))
+    decodeSlice = dicom_to_nrrd.decodeSlice
+    def failingDecode(sl, plane):
+        if sl['path'] == files[1]:
+            raise RuntimeError('decode error')
+        decodeSlice(sl, plane)
+    monkeypatch.setattr(dicom_to_nrrd, 'decodeSlice', failingDecode)
+
+    # The decode error is raised (not the size check of the writer), and the
+    # partial file is removed
+    with pytest.raises(RuntimeError, match='decode error'):
+        dicom_to_nrrd.exportNrrd(files, str(tmp_path), 'out', stream=True)
+    assert not os.path.exists(os.path.join(str(tmp_path), 'out.nrrd'))
+
+
+def test_without_slice_location(tmp_path):
+
+    # The geometry is taken from ImagePositionPatient/ImageOrientationPatient
+    files = writeSeries(str(tmp_path))
+    for path in files:
+        ds = pydicom.dcmread(path)
+        del ds.SliceLocation
+        del ds.InstanceNumber
+        ds.save_as(path)
+    written = dicom_to_nrrd.exportNrrd(files, str(tmp_path), 'out')
+    data, header = nrrd.read(written['files'][0])
+    assert np.array_equal(data, referenceVolume(files))
+    assert np.allclose(header['space directions'], np.diag([0.5, 0.5, 2.0]))
+
+
+def test_exact_high_bits(tmp_path):
+
+    files = writeSeries(str(tmp_path), slope=1, intercept=-1024)
+    written = dicom_to_nrrd.exportNrrd(files, str(tmp_path), 'out', rescale='exact')
+    data, header = nrrd.read(written['files'][0])
+    assert data.dtype == np.int16
+    assert np.array_equal(data, referenceVolume(files))
+
+
+def test_out_of_range_fallback(tmp_path):
+
+    # A negative intercept gives int16 in the 'rescaled' mode, which cannot
+    # hold the 16-bit stored values: the image is written as float64
+    files = writeSeries(str(tmp_path), bitsStored=16, intercept=-1)
+    for stream in [False, True]:
+        written = dicom_to_nrrd.exportNrrd(files, str(tmp_path), 'out', stream=stream)
+        data, header = nrrd.read(written['files'][0])
+        assert data.dtype == np.float64
+        assert np.array_equal(data, referenceVolume(files))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from sample_intensities import roiRegion, extractRegion, buildROIIndex, labelMapIndices
+
+
+#  Tests of the ROI region read from the images (run with pytest)
+
+
+#
+# Label map with two ROIs far apart along the first axis and a third one
+# overlapping the first
+#
+def makeLabelMap():
+
+    labelArray = np.zeros((40, 24, 20), dtype=np.uint8)
+    labelArray[1:4, 3:8, 2:6] = 1
+    labelArray[35:39, 5:9, 10:15] = 2
+    labelArray[2:6, 10:12, 4:7] = 3
+    return labelArray
+
+
+def test_roi_region():
+
+    slabs, box = roiRegion(makeLabelMap())
+    assert slabs == [slice(1, 6), slice(35, 39)]
+    assert box == (slice(3, 12), slice(2, 15))
+
+    # Touching ranges are merged
+    labelArray = np.zeros((10, 4, 4), dtype=np.uint8)
+    labelArray[2:4, 0, 0] = 1
+    labelArray[4:6, 1, 1] = 2
+    assert roiRegion(labelArray)[0] == [slice(2, 6)]
+
+    slabs, box = roiRegion(np.zeros((10, 4, 4), dtype=np.uint8))
+    assert slabs == []
+    assert extractRegion(np.zeros((10, 4, 4)), slabs, box).shape == (0, 0, 0)
+
+
+def test_roi_index():
+
+    labelArray = makeLabelMap()
+    roiIndex = buildROIIndex(labelArray, roiRegion(labelArray))
+    assert roiIndex['shape'] == (9, 9, 13)
+    assert list(roiIndex['labels']) == [1, 2, 3]
+    assert list(roiIndex['counts']) == [60, 80, 24]
+
+    # The voxels of the region map back to the voxels of the ROIs in the label map
+    indices = labelMapIndices(roiIndex, roiIndex['indices'])
+    assert np.array_equal(np.sort(indices), np.flatnonzero(labelArray))
+    assert np.array_equal(labelArray.ravel()[indices], extractRegion(labelArray, roiIndex['slabs'], roiIndex['box']).ravel()[roiIndex['indices']])
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset
+
+from tag_filter import compileFilter, tokenize, indexComponents
+
+
+#  Tests of the filter expressions (run with pytest)
+
+
+#
+# Synthetic headers
+#
+def makeDatasets():
+
+    records = [
+        # SeriesDescription, InversionTime, ImageType, PixelSpacing, (0051,1016)
+        ('T1 map', 100, ['ORIGINAL', 'PRIMARY'], [0.5, 0.5], 'R/DIS2D'),
+        ('T1 map', 500, ['ORIGINAL', 'PRIMARY'], [0.5, 0.5], 'P/DIS2D'),
+        ('localizer', 1000, ['ORIGINAL', 'PRIMARY', 'LOCALIZER'], [1.0, 1.0], 'R/DIS2D'),
+        ('T2 [fast]', None, ['DERIVED'], [0.75, 0.5], None),
+        ]
+    datasets = []
+    for description, ti, imageType, spacing, complexPart in records:
+        ds = Dataset()
+        ds.SeriesDescription = description
+        if ti != None:
+            ds.InversionTime = ti
+        ds.ImageType = imageType
+        ds.PixelSpacing = spacing
+        if complexPart != None:
+            ds.add_new(0x00511016, 'LO', complexPart)
+        datasets.append(ds)
+    return datasets
+
+
+#
+# Columns of the file index for the datasets (str() of the values, '' when
+# missing, as recorded by dicom_to_nrrd.py)
+#
+def indexColumns(datasets, tags):
+
+    columns = {}
+    for tag in tags:
+        columns[tag] = [str(ds[tag].value) if tag in ds else '' for ds in datasets]
+    return columns
+
+
+#
+# Evaluate an expression on the headers and on the index; both must agree
+#
+def select(text):
+
+    datasets = makeDatasets()
+    tagFilter = compileFilter(text)
+    matched = [tagFilter.matches(ds) for ds in datasets]
+    evaluated = tagFilter.evaluate(indexColumns(datasets, tagFilter.tags))
+    assert list(evaluated) == matched
+    return [i for i, m in enumerate(matched) if m]
+
+
+def test_tokenize():
+
+    assert tokenize('InversionTime in 100..1000') == [('word', 'InversionTime'), ('word', 'in'),
+                                                      ('word', '100'), ('op', '..'), ('word', '1000')]
+    assert tokenize('00280030[0] >= 0.5') == [('word', '00280030'), ('op', '['), ('word', '0'),
+                                             ('op', ']'), ('op', '>='), ('word', '0.5')]
+    assert tokenize('00511016 == R/DIS2D') == [('word', '00511016'), ('op', '=='), ('word', 'R/DIS2D')]
+    assert tokenize('SeriesDescription == "T1 map"') == [('word', 'SeriesDescription'), ('op', '=='),
+                                                        ('string', '"T1 map"')]
+
+
+def test_index_components():
+
+    assert indexComponents('') == []
+    assert indexComponents('R/DIS2D') == ['R/DIS2D']
+    assert indexComponents('[0.5, 0.5]') == ['0.5', '0.5']
+    assert indexComponents("['ORIGINAL', 'PRIMARY']") == ['ORIGINAL', 'PRIMARY']
+
+
+def test_comparisons():
+
+    assert select('InversionTime == 500') == [1]
+    assert select('InversionTime = 500') == [1]
+    assert select('InversionTime != 500') == [0, 2, 3]
+    assert select('InversionTime < 500') == [0]
+    assert select('InversionTime >= 500') == [1, 2]
+    assert select('00511016 == R/DIS2D') == [0, 2]
+    assert select('SeriesDescription == "T1 map"') == [0, 1]
+
+
+def test_in():
+
+    assert select('InversionTime in 100..500') == [0, 1]
+    assert select('InversionTime in (100, 1000)') == [0, 2]
+    assert select('00511016 in (R/DIS2D, "P/DIS2D")') == [0, 1, 2]
+
+
+def test_strings():
+
+    assert select('SeriesDescription ~ "^T[12]"') == [0, 1, 3]
+    assert select('SeriesDescription ~ "\\\\[fast\\\\]"') == [3]
+    assert select('ImageType contains LOCALIZER') == [2]
+    assert select('00511016 exists') == [0, 1, 2]
+    assert select('InversionTime exists') == [0, 1, 2]
+
+
+def test_multi_valued():
+
+    assert select('PixelSpacing == 0.5') == [0, 1, 3]
+    assert select('PixelSpacing[0] == 0.5') == [0, 1]
+    assert select('PixelSpacing[1] == 0.5') == [0, 1, 3]
+    assert select('ImageType[2] exists') == [2]
+    assert select('00280030[0] > 0.6') == [2, 3]
+
+
+def test_precedence():
+
+    # "and" binds tighter than "or", and "not" tighter than "and"
+    assert select('InversionTime == 100 or InversionTime == 500 and 00511016 == R/DIS2D') == [0]
+    assert select('(InversionTime == 100 or InversionTime == 500) and 00511016 == P/DIS2D') == [1]
+    assert select('not ImageType contains LOCALIZER and 00511016 == R/DIS2D') == [0]
+    assert select('not (ImageType contains LOCALIZER and 00511016 == R/DIS2D)') == [0, 1, 3]
+    assert select('not not InversionTime == 100') == [0]
+
+
+def test_tags():
+
+    tagFilter = compileFilter('InversionTime in 100..1000 and 00511016 == R/DIS2D')
+    assert tagFilter.tags == {0x00180082, 0x00511016}
+
+
+@pytest.mark.parametrize('text', [
+    'SeriesDescription ~ "["',
+    'InversionTime in 100..',
+    'InversionTime in A..B',
+    'InversionTime >',
+    'NotAKeyword == 1',
+    'InversionTime like 1',
+    '(InversionTime == 1',
+    'InversionTime == 1 )',
+    'PixelSpacing[x] == 1',
+    'InversionTime == 1 and',
+    ])
+def test_invalid(text):
+
+    with pytest.raises(ValueError):
+        compileFilter(text)